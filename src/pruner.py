@@ -1,12 +1,25 @@
-import copy
 import json
 import logging
 import os
-import re
 import yaml
 import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from prunerLib import checkConfiguration
+from prunerLib import expiryIndex
+from prunerLib import memoryProfiler
 from prunerLib import quayApi
+from prunerLib import registrySnapshot
+from prunerLib import responseCache
+from prunerLib import tagSelection
+from prunerLib import webhookReceiver
+from prunerLib import workPlanner
+
+# Pool of processes used to select the tags to delete (environment variable SELECTION_PROCESSES), None if the tags are
+# selected in the threads pruning the registries
+selection_pool = None
+selection_pool_processes = 0
 
 
 def setup_logger():
@@ -58,15 +71,19 @@ def prettify_tag_list_of_dict(input_list):
 
 # This function selects and returns the tags that need to be removed based on the values defined in the variable
 # parameter
+# The debug messages of this function contain the whole tag lists, they are built only if the debug level is enabled
+# because this function is executed for each repository and each pruning parameter
 def select_tags_to_remove(organization,repository,tags, parameter, current_ts):
-    logger.debug(
-        f"Invoke function select_tags_to_remove with the following parameters:\n"
-        f"organization {organization}\n"
-        f"repository {repository}\n"
-        f"tags {tags}\n"
-        f"parameter {parameter}\n"
-        f"current_ts {current_ts}\n"
-    )
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug(
+            f"Invoke function select_tags_to_remove with the following parameters:\n"
+            f"organization {organization}\n"
+            f"repository {repository}\n"
+            f"tags {tags}\n"
+            f"parameter {parameter}\n"
+            f"current_ts {current_ts}\n"
+        )
 
     # The dictionary parameter must be contains at least one of the two keys keep_tags_younger_than and keep_n_tags
     if 'keep_n_tags' not in parameter.keys() and 'keep_tags_younger_than' not in parameter.keys():
@@ -75,75 +92,177 @@ def select_tags_to_remove(organization,repository,tags, parameter, current_ts):
             f"contain at least one of the following parameters: keep_n_tags keep_tags_younger_than")
         os._exit(1)
 
-    # Filter tags based on the regular expression defined in tag_filter
-    pattern=parameter["tag_filter"]
-    matches = []
-    for tag in tags["tags"]:
-        match = re.search(pattern, tag["name"])
-        if match:
-            matches.append(tag)
-    matches_len = len(matches)
-    logger.debug(f"The following tags { [tag['name'] for tag in matches] } have been matched by the regular expression {pattern} ")
-
-    # If keep_n_tags is defined in parameter, filter the tags that needs to be deleted based on this condition and store
-    # them in tag_deleted_by_keep_tag_number
-    if "keep_n_tags" in parameter.keys():
-        keep_tag_number=int(parameter["keep_n_tags"])
-        if matches_len > keep_tag_number:
-            end_index = matches_len - keep_tag_number
-            sorted_matches = sorted(matches, key=lambda t: t["start_ts"])
-            tag_deleted_by_keep_tag_number = sorted_matches[0:end_index]
-        else:
-            tag_deleted_by_keep_tag_number = []
-        logger.debug (f"The tags of the organization '{organization}' and repository '{repository}' that can be "
-                      f"deleted based on parameter 'keep_n_tags: '{keep_tag_number}' are: "
-                      f"{json.dumps(prettify_tag_list_of_dict(tag_deleted_by_keep_tag_number), indent=4)} ")
-
-    # If keep_tags_younger_than is defined in parameter, filter the tags that needs to be deleted based on this
-    # condition and store them in tag_deleted_by_keep_tags_younger_than
-    if "keep_tags_younger_than" in parameter.keys():
-        keep_tags_younger_than = int(parameter["keep_tags_younger_than"])
-        # the unit of measure of keep_tags_younger_than is days,keep_tags_younger_than_seconds convert it in seconds
-        keep_tags_younger_than_seconds=keep_tags_younger_than*24*3600
-        # Select tags if the different between current timestamp and the tag start_ts value is greater than
-        # keep_tags_younger_than_seconds
-        tag_deleted_by_keep_tags_younger_than=[tag for tag in matches
-                                                   if (current_ts - tag["start_ts"] ) >  keep_tags_younger_than_seconds
-                                               ]
+    # The selection is executed by tagSelection.select_tags, the same function used by the selection pool
+    if debug_enabled:
+        matches = tagSelection.match_tags(tags["tags"], parameter["tag_filter"])
+        logger.debug(f"The following tags { [tag['name'] for tag in matches] } have been matched by the regular "
+                     f"expression {parameter['tag_filter']} ")
+    result = tagSelection.select_tags(tags["tags"], parameter, current_ts)
+
+    if debug_enabled:
         logger.debug(f"The tags of the organization '{organization}' and repository '{repository}' that can be deleted "
-                     f"based on parameter 'keep_tags_younger_than: '{keep_tags_younger_than}' are: "
-                     f"{json.dumps(prettify_tag_list_of_dict(tag_deleted_by_keep_tags_younger_than), indent=4)}")
-
-    result=[]
-    # If keep_n_tags and keep_tags_younger_than parameters are both defined, the function return the intersection of
-    # both list tag_deleted_by_keep_tag_number tag_deleted_by_keep_tags_younger_than
-    # A tag will be selected to be deleted only if tag is present in tag_deleted_by_keep_tag_number and
-    # tag_deleted_by_keep_tags_younger_than
-    if 'keep_n_tags' in parameter.keys() and 'keep_tags_younger_than' in parameter.keys():
-        for tag1 in tag_deleted_by_keep_tag_number:
-            if any(tag2['name'] == tag1['name'] for tag2 in tag_deleted_by_keep_tags_younger_than):
-                result.append(copy.deepcopy(tag1))
-
-    # If keep_n_tags parameter is defined and keep_tags_younger_than parameter is not defined, the function returns the
-    # tag deleted based on the condition keep_n_tags
-    elif 'keep_n_tags' in parameter.keys() and 'keep_tags_younger_than' not in parameter.keys():
-        result=tag_deleted_by_keep_tag_number
-    # If tag_deleted_by_keep_tags_younger_than parameter is defined and keep_n_tags parameter is not defined, the
-    # function returns the tag deleted based on the condition tag_deleted_by_keep_tags_younger_than
-    elif 'keep_tags_younger_than' in parameter.keys() and 'keep_n_tags' not in parameter.keys():
-        result=tag_deleted_by_keep_tags_younger_than
-
-    logger.debug(f"The tags of the organization '{organization}' and repository '{repository}' that can be deleted "
-                f"based on all the parameters '{parameter}' are: "
-                f"{json.dumps( prettify_tag_list_of_dict(result),indent=4 )}")
+                     f"based on all the parameters '{parameter}' are: "
+                     f"{json.dumps( prettify_tag_list_of_dict(result),indent=4 )}")
     return result
 
 
+# This function applies the list of pruning parameters to the tags of a repository in order: the tags selected by a
+# parameter are removed from the tags evaluated by the next parameters.
+# It returns the list of all the tags selected to be removed
+def select_repository_tags_to_remove(organization, repository, tags, parameters, current_ts):
+    return tagSelection.select_tags_in_order(
+        tags["tags"], parameters, current_ts,
+        lambda remaining_tags, parameter: select_tags_to_remove(organization, repository, {"tags": remaining_tags},
+                                                                parameter, current_ts)
+    )
+
+
+# This function returns the tags of the repository image_name of the organization, or None if the repository is
+# skipped (repository with state MIRROR or READ_ONLY, or repository not found or not accessible by the token, i.e.
+# deleted after the listing of the organization or notified by a push notification of an unknown repository)
+def fetch_repository_tags(quay_host, app_token, api_timeout, organization, image_name, report=None):
+    if report is not None:
+        report["repositories"] += 1
+
+    try:
+        # If the transport of the registry multiplexes the requests (HTTP/2), the tags are fetched concurrently with
+        # the state of the repository
+        tags_future = quayApi.submit_request(quay_host, quayApi.get_tags_json, logger, quay_host, app_token,
+                                             api_timeout, organization, image_name)
+        repository_state = get_repo_state_parameter(quay_host, app_token, api_timeout, organization, image_name)
+        if repository_state in ["MIRROR", "READ_ONLY"]:
+            logger.warning(f"The repository ' {organization} / {image_name} has been skipped because its state is "
+                           f"{repository_state}")
+            return None
+
+        # The tags are fetched only once, all the parameters are applied to this list of tags
+        if tags_future is not None:
+            image_tags = tags_future.result()
+        else:
+            image_tags = quayApi.get_tags_json(logger,quay_host, app_token, api_timeout, organization, image_name)
+    except quayApi.ErrorAPIResponse as err:
+        if err.status_code not in [403, 404]:
+            raise
+        logger.warning(f"The repository {organization}/{image_name} of the registry {quay_host} has been skipped "
+                       f"because it doesn't exist or it isn't accessible: {err}")
+        return None
+
+    if image_tags is not None:
+        registrySnapshot.record_repository(quay_host, organization, image_name, image_tags)
+    return image_tags
+
+
+# This function deletes (or only prints in DRY_RUN mode) the tags bad_tags of the repository image_name selected using
+# the list of pruning parameters. It returns an empty list if there aren't errors during tag deletion API Request,
+# otherwise it returns a list of strings containing a human-readable message describing the API Response errors
+def remove_selected_tags(quay_host, app_token, api_timeout, organization, image_name, parameters, bad_tags, dry_run,
+                         report=None):
+    delete_tag_error_list = []
+
+    if bad_tags == []:
+        logger.info(
+            f"No tags to delete found for image {image_name} "
+            f"with patterns {[param['tag_filter'] for param in parameters]}"
+        )
+        return delete_tag_error_list
+
+    if report is not None:
+        report["tags_selected"] += len(bad_tags)
+
+    if dry_run:
+        for tag in prettify_tag_list_of_dict(bad_tags):
+            logger.info( f"DRY-RUN Candidate tags for deletion "
+                         f"for image {organization} / {image_name}:{tag['name']}"
+                         f"\t\tlast_modified: {tag['last_modified']} \tstart_ts: {tag['start_ts']}"
+                         )
+    else:
+        current_repository_delete_tags_result = quayApi.delete_tags(logger, quay_host, app_token, api_timeout, organization, image_name, bad_tags)
+        if current_repository_delete_tags_result != []:
+            delete_tag_error_list.extend(current_repository_delete_tags_result)
+
+    return delete_tag_error_list
+
+
+# This function prunes the tags of the repository image_name of the organization using the list of pruning
+# parameters. It returns an empty list if there aren't errors during tag deletion API Request, otherwise it returns
+# a list of strings containing a human-readable message describing the API Response errors
+# last_modified is the timestamp of the last push of the repository returned by the repository listing
+def prune_repository(quay_host, app_token, api_timeout, organization, image_name, parameters, dry_run, report=None,
+                     last_modified=None):
+    image_tags = fetch_repository_tags(quay_host, app_token, api_timeout, organization, image_name, report)
+    if image_tags is None:
+        return []
+
+    logger.info(f"Apply filters: {[param['tag_filter'] for param in parameters]}")
+    current_ts=int(time.time())
+    bad_tags = select_repository_tags_to_remove(organization, image_name, image_tags, parameters, current_ts)
+    delete_tag_error_list = remove_selected_tags(quay_host, app_token, api_timeout, organization, image_name,
+                                                 parameters, bad_tags, dry_run, report)
+    record_repository_evaluation(quay_host, organization, image_name, parameters, image_tags, bad_tags,
+                                 last_modified, current_ts, dry_run, delete_tag_error_list)
+    return delete_tag_error_list
+
+
+# Record in the expiry index the next timestamp at which the selection of the tags of the repository can change.
+# Nothing is recorded in DRY_RUN mode because the tags selected have not been deleted
+def record_repository_evaluation(quay_host, organization, image_name, parameters, image_tags, bad_tags,
+                                 last_modified, current_ts, dry_run, delete_tag_error_list):
+    if dry_run or not expiryIndex.enabled:
+        return
+    bad_tag_names = set(tag["name"] for tag in bad_tags)
+    remaining_tags = [tag for tag in image_tags["tags"] if tag["name"] not in bad_tag_names]
+    next_evaluation_ts = tagSelection.get_next_selection_change_ts(remaining_tags, parameters)
+    expiryIndex.record_evaluation(quay_host, organization, image_name, parameters, last_modified, next_evaluation_ts,
+                                  current_ts, delete_tag_error_list == [])
+
+
+# This function is used instead of prune_repository when the selection pool is enabled (environment variable
+# SELECTION_PROCESSES): the tags of each repository are fetched in this thread, the selection of the tags to delete is
+# executed by the processes of the pool and the tags are deleted in this thread when the selection is completed.
+# At most 2 repositories for each process of the pool are waiting for the selection at the same time
+# images is the list of the repositories returned by the repository listing
+def prune_repositories_with_selection_pool(quay_host, app_token, api_timeout, organization, images, parameters,
+                                           dry_run, report=None):
+    delete_tag_error_list = []
+    pending = deque()
+
+    def complete_oldest_selection():
+        image, image_tags, current_ts, future = pending.popleft()
+        bad_tag_names = set(future.result())
+        bad_tags = [tag for tag in image_tags["tags"] if tag["name"] in bad_tag_names]
+        repository_delete_tag_error_list = remove_selected_tags(quay_host, app_token, api_timeout, organization,
+                                                                image["name"], parameters, bad_tags, dry_run, report)
+        record_repository_evaluation(quay_host, organization, image["name"], parameters, image_tags, bad_tags,
+                                     image.get("last_modified"), current_ts, dry_run,
+                                     repository_delete_tag_error_list)
+        delete_tag_error_list.extend(repository_delete_tag_error_list)
+
+    for image in images:
+        with memoryProfiler.measure("repository", f"{quay_host}/{organization}/{image['name']}"):
+            image_tags = fetch_repository_tags(quay_host, app_token, api_timeout, organization, image["name"], report)
+        if image_tags is None:
+            continue
+
+        compact_tags = [(tag["name"], tag["start_ts"]) for tag in image_tags["tags"]]
+        current_ts = int(time.time())
+        future = selection_pool.submit(tagSelection.select_tag_names_to_remove, compact_tags, parameters, current_ts)
+        pending.append((image, image_tags, current_ts, future))
+        while len(pending) > 2 * selection_pool_processes or (pending and pending[0][3].done()):
+            complete_oldest_selection()
+
+    while pending:
+        complete_oldest_selection()
+
+    return delete_tag_error_list
+
+
 # This function returns an empty list if there aren't errors during tag deletion API Request
 # Otherwise it returns a list of strings containing a human-readable message describing the API Response errors
+# If report is a dictionary, the function increments its counters 'repositories', 'tags_selected' and
+# 'expected_api_calls'
 def apply_pruner_rule(
         quay_host, app_token, api_timeout, organization,
-        parameters, debug, dry_run):
+        parameters, debug, dry_run, report=None):
     logger.debug(
         f"Invoke function apply_pruner_rule with the following parameters:\n"
         f"quay_host {quay_host}\n"
@@ -157,63 +276,275 @@ def apply_pruner_rule(
 
     repos = quayApi.get_repo_list_json(logger, quay_host, app_token, api_timeout, organization)
     if repos is None:
-       return
+       if report is not None:
+           report["organizations_not_listed"] += 1
+       return delete_tag_error_list
+    registrySnapshot.record_organization(quay_host, organization)
 
-    logger.debug(
-        f"{organization}'s repositories: {json.dumps(repos, indent=4)}"
-    )
-
-    for image in repos["repositories"]:
+    if debug:
+        logger.debug(
+            f"{organization}'s repositories: {json.dumps(repos, indent=4)}"
+        )
 
-        repository_state = get_repo_state_parameter(quay_host, app_token, api_timeout, organization, image["name"])
-        if repository_state in ["MIRROR", "READ_ONLY"]:
-            image_name=image["name"]
-            logger.warning(f"The repository ' {organization} / {image_name} has been skipped because its state is "
-                           f"{repository_state}")
-            continue
+    # The expiry index skips the repositories whose selection of tags to delete can't have changed since their last
+    # evaluation. While exporting a snapshot all the repositories are evaluated, the snapshot must contain their tags
+    current_ts = int(time.time())
+    images = [image for image in repos["repositories"]
+              if expiryIndex.needs_evaluation(quay_host, organization, image["name"], parameters,
+                                              image.get("last_modified"), current_ts)
+              or registrySnapshot.enabled]
+    if report is not None:
+        report["repositories_skipped_by_expiry_index"] += len(repos["repositories"]) - len(images)
+
+    # Two API requests for each repository: repository state and first page of tags
+    expected_api_calls = 2 * len(images)
+    logger.info(f"Organization {organization} of registry {quay_host}: {len(repos['repositories'])} repositories, "
+                f"{len(images)} to evaluate, expected API requests to prune them at least {expected_api_calls}")
+    if report is not None:
+        report["expected_api_calls"] += expected_api_calls
+
+    if selection_pool is not None:
+        delete_tag_error_list.extend(
+            prune_repositories_with_selection_pool(quay_host, app_token, api_timeout, organization, images,
+                                                   parameters, dry_run, report)
+        )
+        return delete_tag_error_list
 
-        for param in parameters:
-            logger.info(f"Apply filter: {param['tag_filter']}")
-            image_tags = quayApi.get_tags_json(logger,quay_host, app_token, api_timeout, organization, image["name"])
-            if image_tags is None:
-                continue
-
-            current_ts=int(time.time())
-            bad_tags = select_tags_to_remove(organization,image["name"],image_tags, param, current_ts)
-            if bad_tags is None:
-                logger.info(
-                    f"No tags to delete found for image {image['name']} "
-                    f"with pattern {param['tag_filter']}"
-                )
-                continue
-
-            if dry_run:
-                for tag in prettify_tag_list_of_dict(bad_tags):
-                    logger.info( f"DRY-RUN Candidate tags for deletion "
-                                 f"for image {organization} / {image['name']}:{tag['name']}"
-                                 f"\t\tlast_modified: {tag['last_modified']} \tstart_ts: {tag['start_ts']}"
-                                 )
-            else:
-                current_repository_delete_tags_result = quayApi.delete_tags(logger, quay_host, app_token, api_timeout, organization, image["name"], bad_tags)
-                if current_repository_delete_tags_result != []:
-                    delete_tag_error_list.extend(current_repository_delete_tags_result)
+    for image in images:
+        with memoryProfiler.measure("repository", f"{quay_host}/{organization}/{image['name']}"):
+            delete_tag_error_list.extend(
+                prune_repository(quay_host, app_token, api_timeout, organization, image["name"], parameters, dry_run,
+                                 report, image.get("last_modified"))
+            )
 
     return delete_tag_error_list
 
+
+# Return a new report dictionary of the execution on the Quay registry quay_host
+def create_registry_report(quay_host):
+    return {
+        "quay_url": quay_host,
+        "organizations": 0,
+        "repositories": 0,
+        "repositories_skipped_by_expiry_index": 0,
+        "organizations_not_listed": 0,
+        "tags_selected": 0,
+        "expected_api_calls": 0,
+        "api_calls": 0,
+        "response_cache_hits": 0,
+        "response_cache_misses": 0,
+        "errors": [],
+        "elapsed_seconds": 0.0,
+        # True if all the organizations of the work plan have been listed
+        "completed": False
+    }
+
+
+# This function applies the rules and the default rule defined in conf_yaml to the Quay registry quay_host and returns
+# a report dictionary of the execution. The key 'errors' of the report contains the list of strings describing the
+# errors occurred during the tag deletion API Requests and the error that interrupted the pruning of the registry
+# (unexpected API response), if any
+def prune_registry(quay_host, app_token, api_timeout, conf_yaml, debug, dry_run):
+    start_ts = time.time()
+    report = create_registry_report(quay_host)
+
+    try:
+        prune_registry_organizations(quay_host, app_token, api_timeout, conf_yaml, debug, dry_run, report)
+    except quayApi.ErrorAPIResponse403InsufficientScope:
+        error = (f"The token provided for the registry '{quay_host}' hasn't superadmin privileges and "
+                 f"the call to the API 'https://{quay_host}/api/v1/superuser/organizations/' has failed with "
+                 f"the error 'Insufficient scope' status code 403. If you want use an access token without "
+                 f"superadmin privileges disable the default_rule in the configuration file. If you want enable"
+                 f"the default rule, provide a token with superadmin privileges")
+        logger.error(error)
+        report["errors"].append(error)
+    except quayApi.ErrorAPIResponse as err:
+        logger.error(f"The pruning of the registry {quay_host} has been interrupted: {err}")
+        report["errors"].append(str(err))
+    # Any other failure (i.e. a read timeout) interrupts only this registry. The report keeps the counters and the
+    # errors collected before the failure
+    except Exception as err:
+        logger.exception(f"The pruning of the registry {quay_host} has failed")
+        report["errors"].append(f"The pruning of the registry {quay_host} has failed: {err!r}")
+
+    report["api_calls"] = quayApi.get_api_request_count(quay_host)
+    response_cache_counters = responseCache.get_counters(quay_host)
+    report["response_cache_hits"] = response_cache_counters["hits"]
+    report["response_cache_misses"] = response_cache_counters["misses"]
+    report["elapsed_seconds"] = round(time.time() - start_ts, 3)
+    return report
+
+
+def prune_registry_organizations(quay_host, app_token, api_timeout, conf_yaml, debug, dry_run, report):
+    # The list of all the organizations of the registry is needed only by the default rule
+    org_list = None
+    if conf_yaml["default_rule"]["enabled"]:
+        org_list = get_orgs_list(quay_host, app_token, api_timeout)
+        registrySnapshot.record_organization_list(quay_host, org_list)
+        if debug:
+            logger.debug(f"Organizations complete list of registry {quay_host}: {org_list}")
+
+    # Resolve the rules and the default rule in a work plan containing each organization only once
+    plan = workPlanner.plan_organizations(logger, conf_yaml, org_list)
+    report["expected_api_calls"] = workPlanner.count_expected_api_calls(plan, conf_yaml["default_rule"]["enabled"])
+    logger.info(f"Work plan of registry {quay_host}: {len(plan)} organizations, expected API requests to list their "
+                f"repositories {report['expected_api_calls']}")
+    if debug:
+        logger.debug(f"Work plan of registry {quay_host}: {json.dumps(plan, indent=4)}")
+
+    for org, params in plan.items():
+        report["organizations"] += 1
+        with memoryProfiler.measure("organization", f"{quay_host}/{org}"):
+            report["errors"].extend(
+                apply_pruner_rule(quay_host, app_token, api_timeout, org, params, debug, dry_run, report)
+            )
+    report["completed"] = report["organizations_not_listed"] == 0
+
+
+# This function returns the list of registries to prune. Each registry is a dictionary with the keys quay_url,
+# app_token, max_requests_per_second and conf (the dictionary containing the keys rules and default_rule).
+# If the configuration file doesn't define the key 'registries', the list contains only the registry defined by the
+# environment variables QUAY_URL and QUAY_APP_TOKEN
+def get_registries_list(conf_yaml):
+    if 'registries' not in conf_yaml.keys():
+        return [{
+            "quay_url": os.getenv('QUAY_URL'),
+            "app_token": os.getenv('QUAY_APP_TOKEN'),
+            "max_requests_per_second": 0.0,
+            "conf": conf_yaml
+        }]
+
+    registries = []
+    for registry in conf_yaml["registries"]:
+        registries.append({
+            "quay_url": registry["quay_url"],
+            "app_token": os.getenv(registry["quay_app_token_env"]),
+            "max_requests_per_second": float(registry.get("max_requests_per_second", "0")),
+            "conf": {"rules": registry["rules"], "default_rule": registry["default_rule"]}
+        })
+    return registries
+
+
+# Return the value of the environment variable QUAY_TLS_VERIFY converted to the verify value used by the HTTP
+# transports: a boolean or the path of a CA bundle. The default value is False (TLS certificate not verified)
+def get_tls_verify():
+    quay_tls_verify = os.getenv('QUAY_TLS_VERIFY', 'False')
+    if quay_tls_verify.upper() in ['TRUE', 'FALSE']:
+        return quay_tls_verify.upper() == 'TRUE'
+    return quay_tls_verify
+
+
+# Configure the HTTP transport and the rate limiter of each registry
+def configure_registries(registries, transport_name="requests", tls_verify=False):
+    for registry in registries:
+        quayApi.configure_registry(registry["quay_url"], registry["max_requests_per_second"],
+                                   transport_name=transport_name, verify=tls_verify)
+
+
+# Prune all the registries concurrently (one thread for each registry). Each registry uses its own HTTP transport
+# and rate limiter configured by configure_registries. The function returns the list of the registries' reports.
+# An unexpected error in the thread of a registry is recorded in the report of this registry, the other registries
+# are pruned anyway
+def prune_registries(registries, api_timeout, debug, dry_run):
+
+    with ThreadPoolExecutor(max_workers=len(registries)) as executor:
+        futures = [
+            executor.submit(prune_registry, registry["quay_url"], registry["app_token"], api_timeout,
+                            registry["conf"], debug, dry_run)
+            for registry in registries
+        ]
+        # prune_registry reports the errors of its registry instead of raising them
+        return [future.result() for future in futures]
+
+
+# Remove from the expiry index the repositories not listed by the registries scanned completely (deleted repositories
+# and organizations no longer pruned)
+def remove_unlisted_repositories_from_expiry_index(reports):
+    quay_hosts = [report["quay_url"] for report in reports if report["completed"]]
+    removed = expiryIndex.remove_unseen_entries(quay_hosts)
+    if removed > 0:
+        logger.info(f"{removed} repositories not listed by the registries {quay_hosts} removed from the expiry index")
+
+
+# Prune a single repository pushed to the registry quay_host (webhook receiver mode) using the parameters of the rule
+# that applies to its organization. If quay_host is None or unknown and only one registry is configured, the
+# repository belongs to this registry
+def prune_pushed_repository(registries, api_timeout, dry_run, quay_host, organization, repository):
+    registry = next((r for r in registries if r["quay_url"] == quay_host), None)
+    if registry is None and len(registries) == 1:
+        registry = registries[0]
+    if registry is None:
+        logger.warning(f"The repository {organization}/{repository} has been skipped because the registry "
+                       f"{quay_host} is not configured")
+        return
+
+    parameters = workPlanner.get_organization_parameters(logger, registry["conf"], organization)
+    if parameters is None:
+        logger.info(f"The repository {organization}/{repository} has been skipped because its organization is not "
+                    f"pruned by any rule of the registry {registry['quay_url']}")
+        return
+
+    start_ts = int(time.time())
+    try:
+        errors = prune_repository(registry["quay_url"], registry["app_token"], api_timeout, organization, repository,
+                                  parameters, dry_run)
+    finally:
+        expiryIndex.retry_if_not_recorded(registry["quay_url"], organization, repository, start_ts, int(time.time()))
+    if errors != []:
+        errors_multiline_str = "\n".join(errors)
+        logger.error(f"Errors on tag deletion API Requests of the repository {organization}/{repository}:\n"
+                     f"{errors_multiline_str}")
+
+
+# Return the repositories of the expiry index to prune in webhook receiver mode: the repositories that reached their next
+# evaluation timestamp, including the ones already due when the index has been loaded
+def pop_scheduled_repositories():
+    return [expiryIndex.split_key(key) for key in expiryIndex.pop_scheduled(int(time.time()))]
+
+
+# Convert the list of the registries' reports in a multi-line human-readable string
+def format_registries_report(reports):
+    lines = []
+    for report in reports:
+        lines.append(f"Registry {report['quay_url']}: organizations {report['organizations']}, "
+                     f"repositories {report['repositories']} "
+                     f"(skipped by the expiry index {report['repositories_skipped_by_expiry_index']}), "
+                     f"tags selected for deletion {report['tags_selected']}, "
+                     f"API requests {report['api_calls']} (expected at least {report['expected_api_calls']}), "
+                     f"response cache hits {report['response_cache_hits']} "
+                     f"misses {report['response_cache_misses']}, "
+                     f"errors {len(report['errors'])}, elapsed seconds {report['elapsed_seconds']}")
+    lines.append(f"Total: registries {len(reports)}, "
+                 f"organizations {sum(report['organizations'] for report in reports)}, "
+                 f"repositories {sum(report['repositories'] for report in reports)}, "
+                 f"tags selected for deletion {sum(report['tags_selected'] for report in reports)}, "
+                 f"API requests {sum(report['api_calls'] for report in reports)}, "
+                 f"response cache hits {sum(report['response_cache_hits'] for report in reports)} "
+                 f"misses {sum(report['response_cache_misses'] for report in reports)}, "
+                 f"errors {sum(len(report['errors']) for report in reports)}")
+    return "\n".join(lines)
+
 if __name__ == "__main__":
     logger = setup_logger()
 
     checkConfiguration.check_environment_variables(logger)
 
     debug = True if os.getenv('DEBUG', 'False').upper() == 'TRUE' else False
+    # The debug messages are printed only if DEBUG is True
+    if not debug:
+        logger.setLevel(logging.INFO)
     dryRun = True if os.getenv('DRY_RUN', 'False').upper() == 'TRUE' else False
-    quayUrl = os.getenv('QUAY_URL')
-    oauthToken = os.getenv('QUAY_APP_TOKEN')
     api_timeout = float(os.getenv('QUAY_API_TIMEOUT')) if os.getenv('QUAY_API_TIMEOUT') is not None else 60.0
+    http_transport = os.getenv('QUAY_HTTP_TRANSPORT', 'requests')
+    tls_verify = get_tls_verify()
+    memory_profile = True if os.getenv('MEMORY_PROFILE', 'False').upper() == 'TRUE' else False
+    snapshot_export_file = os.getenv('SNAPSHOT_EXPORT_FILE')
 
-    logger.info(f"DEBUG {debug}, DRY_RUN {dryRun}, QUAY_URL {quayUrl}")
-    if debug:
-        logger.debug(f"Quay App Token: {oauthToken}")
+    if snapshot_export_file is not None:
+        registrySnapshot.start_export()
+
+    if memory_profile:
+        memoryProfiler.start()
 
     configFile = "/opt/conf/config.yaml"
     try:
@@ -227,63 +558,81 @@ if __name__ == "__main__":
         logger.exception(f"Error reading file {configFile}: {err}")
         os._exit(1)
 
-    # Define a list of potential errors occurred during the Quay delete tags API requests to show them at the end
-    # of the application execution
-    tags_delete_errors_list=[]
-
-    # Evaluate rules for specific organization lists
-    for rule in conf_yaml["rules"]:
-        params = rule["parameters"]
-
-        for org in rule["organization_list"]:
-            tags_delete_errors_list_during_apply_pruner_rule=apply_pruner_rule(quayUrl, oauthToken, api_timeout, org, params, debug, dryRun)
-            if tags_delete_errors_list_during_apply_pruner_rule != []:
-                tags_delete_errors_list.extend(tags_delete_errors_list_during_apply_pruner_rule)
+    if 'registries' not in conf_yaml.keys():
+        checkConfiguration.check_single_registry_environment_variables(logger)
 
-    # Evaluate default rule
-    if conf_yaml["default_rule"]["enabled"]:
-
-        try:
-            org_list = get_orgs_list(quayUrl, oauthToken, api_timeout)
-        except quayApi.ErrorAPIResponse403InsufficientScope:
-            logger.error(f"The token provided by 'QUAY_TOKEN' environment variable hasn't superadmin privileges and "
-                         f"the call to the API 'https://{quayUrl}/api/v1/user/authorizations' has failed with the "
-                         f"error 'Insufficient scope' status code 403. If you want use an access token without "
-                         f"superadmin privileges disable the default_rule in the configuration file. If you want enable"
-                         f"the default rule, provide a token with superadmin privileges using the environment variable "
-                         f"'QUAY_TOKEN'")
-            os._exit(1)
+    registries = get_registries_list(conf_yaml)
 
-        if debug:
-            logger.debug(f"Organizations complete list: {org_list}")
-
-# If the parameter exclude_organizations_regex is not an empty string, initialize org_exclude_list with the list
-# organization names matching the regex defined in exclude_organizations_regex
-        if conf_yaml['default_rule']['exclude_organizations_regex'] != "":
-            exclude_organizations_filter_regex = re.compile(conf_yaml['default_rule']['exclude_organizations_regex'])
-            org_exclude_list = [org for org in org_list if exclude_organizations_filter_regex.match(org)]
-# If the parameter exclude_organizations_regex is an empty string, Initialize org_exclude_list with an empty list
-        else:
-            org_exclude_list = []
-        if debug:
-            logger.debug(f"Organizations excluded using the configuration file parameter exclude_organizations_regex "
-                         f"list: {org_exclude_list}")
-
-        for r in conf_yaml["rules"]:
-            for o in r["organization_list"]:
-                org_exclude_list.append(o)
-        if debug:
-            logger.debug(f"Organizations exclude list: {org_exclude_list}")
-
-        org_default_list = list(set(org_list).difference(set(org_exclude_list)))
-        logger.info(f"Organizations pruned by default_rule: {org_default_list}")
-
-        default_params = conf_yaml["default_rule"]["parameters"]
+    logger.info(f"DEBUG {debug}, DRY_RUN {dryRun}, QUAY_URL {[registry['quay_url'] for registry in registries]}, "
+                f"QUAY_HTTP_TRANSPORT {http_transport}, QUAY_TLS_VERIFY {tls_verify}")
+    if debug:
+        for registry in registries:
+            logger.debug(f"Quay App Token of registry {registry['quay_url']}: {registry['app_token']}")
+
+    configure_registries(registries, http_transport, tls_verify)
+
+    expiry_index_file = os.getenv('EXPIRY_INDEX_FILE')
+    expiry_index_max_age_days = float(os.getenv('EXPIRY_INDEX_MAX_AGE_DAYS', '7'))
+    if expiry_index_file is not None:
+        expiryIndex.load(expiry_index_file, int(time.time()), expiry_index_max_age_days)
+        if snapshot_export_file is not None:
+            logger.warning("SNAPSHOT_EXPORT_FILE is defined: the expiry index doesn't skip any repository during this "
+                           "execution, so the snapshot contains the tags of all the repositories")
+
+    response_cache_dir = os.getenv('QUAY_RESPONSE_CACHE_DIR')
+    if response_cache_dir is not None:
+        responseCache.configure(response_cache_dir, float(os.getenv('QUAY_RESPONSE_CACHE_MAX_MB', '100')))
+
+    selection_pool_processes = int(os.getenv('SELECTION_PROCESSES', '0'))
+    if selection_pool_processes > 0:
+        # The processes are created with the method spawn because the pool is shared by the threads of the registries
+        selection_pool = ProcessPoolExecutor(max_workers=selection_pool_processes,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+    # Webhook receiver mode: prune only the repositories notified by the Quay repository push notifications and run
+    # a full sweep of the registries every WEBHOOK_FULL_SWEEP_INTERVAL_HOURS hours
+    if os.getenv('WEBHOOK_LISTEN_PORT') is not None:
+        def full_sweep():
+            if expiry_index_file is not None:
+                expiryIndex.refresh_due_keys(int(time.time()))
+            reports = prune_registries(registries, api_timeout, debug, dryRun)
+            logger.info(f"Registries report:\n{format_registries_report(reports)}")
+            if expiry_index_file is not None:
+                remove_unlisted_repositories_from_expiry_index(reports)
+                expiryIndex.write(expiry_index_file)
+
+        webhookReceiver.serve(
+            logger,
+            int(os.getenv('WEBHOOK_LISTEN_PORT')),
+            os.getenv('WEBHOOK_TOKEN'),
+            lambda quay_host, organization, repository: prune_pushed_repository(
+                registries, api_timeout, dryRun, quay_host, organization, repository),
+            full_sweep,
+            float(os.getenv('WEBHOOK_DEBOUNCE_SECONDS', '300')),
+            float(os.getenv('WEBHOOK_FULL_SWEEP_INTERVAL_HOURS', '168')) * 3600,
+            # The repositories of the expiry index due between two full sweeps are pruned as pushed repositories
+            pop_scheduled_repositories if expiry_index_file is not None else None
+        )
+        os._exit(0)
+
+    registries_reports = prune_registries(registries, api_timeout, debug, dryRun)
+    if selection_pool is not None:
+        selection_pool.shutdown()
+    if expiry_index_file is not None:
+        remove_unlisted_repositories_from_expiry_index(registries_reports)
+        expiryIndex.write(expiry_index_file)
+    logger.info(f"Registries report:\n{format_registries_report(registries_reports)}")
+    if memory_profile:
+        logger.info(f"Memory report:\n{memoryProfiler.format_report()}")
+    if snapshot_export_file is not None:
+        registrySnapshot.write(snapshot_export_file)
+        logger.info(f"Tags metadata exported to the snapshot file {snapshot_export_file}")
 
-        for org in org_default_list:
-            tags_delete_errors_list_during_apply_pruner_rule=apply_pruner_rule(quayUrl, oauthToken, api_timeout, org, default_params, debug, dryRun)
-            if tags_delete_errors_list_during_apply_pruner_rule != []:
-                tags_delete_errors_list.extend(tags_delete_errors_list_during_apply_pruner_rule)
+    # Define a list of potential errors occurred during the Quay delete tags API requests to show them at the end
+    # of the application execution
+    tags_delete_errors_list = []
+    for registry_report in registries_reports:
+        tags_delete_errors_list.extend(registry_report["errors"])
 
     if tags_delete_errors_list == []:
         logger.info("Application has terminated successfully")
@@ -292,4 +641,4 @@ if __name__ == "__main__":
         tags_delete_errors_list_multiline_str = "\n".join(tags_delete_errors_list)
         logger.error(f"Application has terminated with the following errors on tag deletion API Requests:\n"
                      f"{tags_delete_errors_list_multiline_str}")
-        os._exit(1)
\ No newline at end of file
+        os._exit(1)
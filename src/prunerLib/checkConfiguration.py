@@ -1,10 +1,11 @@
 import re
 import os
+from collections import Counter
 
 
 def check_environment_variables(logger):
     logger.debug("Execute function check_environment_variables")
-    for env_variable in ["DEBUG", "DRY_RUN", "QUAY_URL", "QUAY_APP_TOKEN"]:
+    for env_variable in ["DEBUG", "DRY_RUN"]:
         if env_variable not in os.environ:
             logger.error(f"Terminating the application with an error: "
                          f"The required environment variable {env_variable} is not defined"
@@ -35,11 +36,114 @@ def check_environment_variables(logger):
                      f"number. (example valid value 60.0)'"
                      )
         exit(1)
+
+    memory_profile_env_value = os.getenv("MEMORY_PROFILE")
+    if memory_profile_env_value is not None and memory_profile_env_value.lower() not in ["true", "false"]:
+        logger.error(f"Terminating the application with an error in the environment variables: "
+                     f"The value '{memory_profile_env_value}' of environment variables MEMORY_PROFILE is not valid. "
+                     f"Allowed values: 'true','True','False or 'false'"
+                     )
+        exit(1)
+
+    webhook_listen_port = os.getenv("WEBHOOK_LISTEN_PORT")
+    if webhook_listen_port is not None and not webhook_listen_port.isdigit():
+        logger.error(f"Terminating the application with an error in the environment variables: "
+                     f"The value '{webhook_listen_port}' of environment variables WEBHOOK_LISTEN_PORT is not a valid "
+                     f"port number"
+                     )
+        exit(1)
+
+    # The webhook receiver doesn't accept anonymous notifications: without a token anyone reaching the receiver could
+    # trigger the pruning of any repository
+    if webhook_listen_port is not None and not os.getenv("WEBHOOK_TOKEN"):
+        logger.error("Terminating the application with an error in the environment variables: "
+                     "The environment variable WEBHOOK_TOKEN is required when WEBHOOK_LISTEN_PORT is defined"
+                     )
+        exit(1)
+
+    # The snapshot is written at the end of an execution: the webhook receiver never ends, so the snapshot would only
+    # grow in memory and disable the expiry index for the lifetime of the receiver
+    if webhook_listen_port is not None and os.getenv("SNAPSHOT_EXPORT_FILE") is not None:
+        logger.error("Terminating the application with an error in the environment variables: "
+                     "The environment variable SNAPSHOT_EXPORT_FILE can't be defined when WEBHOOK_LISTEN_PORT is "
+                     "defined, export the snapshot from a CronJob execution"
+                     )
+        exit(1)
+
+    for env_variable in ["WEBHOOK_DEBOUNCE_SECONDS", "WEBHOOK_FULL_SWEEP_INTERVAL_HOURS", "EXPIRY_INDEX_MAX_AGE_DAYS",
+                         "QUAY_RESPONSE_CACHE_MAX_MB"]:
+        env_value = os.getenv(env_variable)
+        if env_value is not None and not env_value.replace('.','',1).isdigit():
+            logger.error(f"Terminating the application with an error in the environment variables: "
+                         f"The value '{env_value}' of environment variables {env_variable} is not a valid float"
+                         f"number."
+                         )
+            exit(1)
+
+    selection_processes = os.getenv("SELECTION_PROCESSES")
+    if selection_processes is not None and not selection_processes.isdigit():
+        logger.error(f"Terminating the application with an error in the environment variables: "
+                     f"The value '{selection_processes}' of environment variables SELECTION_PROCESSES is not a valid "
+                     f"integer number"
+                     )
+        exit(1)
+
+    quay_http_transport = os.getenv("QUAY_HTTP_TRANSPORT")
+    if quay_http_transport is not None and quay_http_transport not in ["requests", "http2"]:
+        logger.error(f"Terminating the application with an error in the environment variables: "
+                     f"The value '{quay_http_transport}' of environment variables QUAY_HTTP_TRANSPORT is not valid. "
+                     f"Allowed values: 'requests' or 'http2'"
+                     )
+        exit(1)
+
+    quay_tls_verify = os.getenv("QUAY_TLS_VERIFY")
+    if quay_tls_verify is not None and quay_tls_verify.lower() not in ["true", "false"] \
+            and not os.path.isfile(quay_tls_verify):
+        logger.error(f"Terminating the application with an error in the environment variables: "
+                     f"The value '{quay_tls_verify}' of environment variables QUAY_TLS_VERIFY is not valid. "
+                     f"Allowed values: 'true','True','False','false' or the path of a CA bundle file"
+                     )
+        exit(1)
     logger.debug("Function check_environment_variables completed with success")
 
 
-def check_configuration_file(logger, conf_yaml):
-    logger.debug("Execute function checkConfigurationFilee")
+# The environment variables QUAY_URL and QUAY_APP_TOKEN are required only when the configuration file doesn't define
+# the key 'registries' (single registry mode)
+def check_single_registry_environment_variables(logger):
+    logger.debug("Execute function check_single_registry_environment_variables")
+    for env_variable in ["QUAY_URL", "QUAY_APP_TOKEN"]:
+        if env_variable not in os.environ:
+            logger.error(f"Terminating the application with an error: "
+                         f"The required environment variable {env_variable} is not defined"
+                         )
+            exit(1)
+    logger.debug("Function check_single_registry_environment_variables completed with success")
+
+
+# The configuration file can define the rules of a single registry (keys 'rules' and 'default_rule') or the rules
+# of several registries (key 'registries', each registry has its own keys 'rules' and 'default_rule')
+def check_configuration_file(logger, conf_yaml, check_tokens=True):
+    logger.debug("Execute function check_configuration_file")
+
+    if not isinstance(conf_yaml, dict):
+        logger.error("Terminating the application with an error in the configuration file: "
+                     "The configuration file config.yaml is not a dictionary"
+                     )
+        exit(1)
+
+    if 'registries' in conf_yaml.keys():
+        verify_value_of_registries_is_a_list(logger, conf_yaml)
+        for registry in conf_yaml["registries"]:
+            verify_registry(logger, registry, check_tokens)
+            check_rules_configuration(logger, registry)
+        verify_registries_are_unique(logger, conf_yaml)
+    else:
+        check_rules_configuration(logger, conf_yaml)
+
+    logger.debug("Function check_configuration_file completed with success")
+
+
+def check_rules_configuration(logger, conf_yaml):
 
     verify_existence_key_rules(logger, conf_yaml)
     verify_existence_key_default_rule(logger, conf_yaml)
@@ -57,7 +161,61 @@ def check_configuration_file(logger, conf_yaml):
     for parameter in conf_yaml["default_rule"]["parameters"]:
         verify_parameter(logger,parameter)
 
-    logger.debug("Function check_configuration_file completed with success")
+
+def verify_value_of_registries_is_a_list(logger, conf_yaml):
+    if not isinstance(conf_yaml["registries"], list) or len(conf_yaml["registries"]) == 0:
+        logger.error("Terminating the application with an error in the configuration file: "
+                     "The value of key 'registries' is not a non-empty list"
+                     )
+        exit(1)
+
+
+def verify_registry(logger, registry, check_tokens=True):
+    if not isinstance(registry, dict):
+        logger.error(f"Terminating the application with an error in the configuration file: "
+                     f"The registry {registry} is not valid, it is not a dictionary"
+                     )
+        exit(1)
+
+    for key in ["quay_url", "quay_app_token_env"]:
+        if key not in registry.keys():
+            logger.error(f"Terminating the application with an error in the configuration file: "
+                         f"The registry {registry.get('quay_url', registry)} is not valid, the key '{key}' is missing"
+                         )
+            exit(1)
+        if not isinstance(registry[key], str) or registry[key] == "":
+            logger.error(f"Terminating the application with an error in the configuration file: "
+                         f"The registry {registry['quay_url']} is not valid, the value of the key '{key}' is not a "
+                         f"non-empty string"
+                         )
+            exit(1)
+
+    if check_tokens and registry["quay_app_token_env"] not in os.environ:
+        logger.error(f"Terminating the application with an error: "
+                     f"The environment variable {registry['quay_app_token_env']} containing the token of the registry "
+                     f"{registry['quay_url']} is not defined"
+                     )
+        exit(1)
+
+    if 'max_requests_per_second' in registry.keys() \
+            and \
+            not (isinstance(registry["max_requests_per_second"], str)
+                 and registry["max_requests_per_second"].replace('.', '', 1).isdigit()):
+        logger.error(f"Terminating the application with an error in the configuration file: "
+                     f"The registry {registry['quay_url']} is not valid, the value of the key "
+                     f"'max_requests_per_second' is not a string representing a number"
+                     )
+        exit(1)
+
+
+def verify_registries_are_unique(logger, conf_yaml):
+    quay_url_counter = Counter(registry["quay_url"] for registry in conf_yaml["registries"])
+    duplicated_quay_url_list = sorted(url for url, count in quay_url_counter.items() if count > 1)
+    if len(duplicated_quay_url_list) > 0:
+        logger.error(f"Terminating the application with an error in the configuration file: "
+                     f"The following registries are defined more than once: {duplicated_quay_url_list}"
+                     )
+        exit(1)
 
 
 def verify_existence_key_rules(logger, conf_yaml):
@@ -0,0 +1,199 @@
+import hashlib
+import heapq
+import json
+import os
+import threading
+
+# Expiry-time index of the repositories (environment variable EXPIRY_INDEX_FILE).
+# For each repository pruned successfully the index persists the next timestamp at which the selection of the tags to
+# delete can change without pushes (a kept tag becomes older than keep_tags_younger_than), the hash of the pruning
+# parameters and the value last_modified of the repository listing.
+# The repositories with a next evaluation timestamp are kept in a priority queue (schedule) ordered by this timestamp:
+# pop_due pops the repositories that reached it. A scan of the registries evaluates a repository only if it has been
+# popped, it has been pushed (last_modified changed), its pruning parameters changed, it is not present in the index or
+# its last evaluation is older than max_age_seconds. In webhook receiver mode the worker pops with pop_scheduled the
+# due repositories (including the ones already due when the index has been loaded) between two full sweeps and prunes
+# them as pushed repositories.
+# A repository whose evaluation failed or has not been recorded (i.e. an API error or DRY_RUN) is scheduled again after
+# RETRY_SECONDS and its evaluated_ts is set to 0, so it is evaluated by every scan until an evaluation succeeds.
+# The entries of the repositories not listed by a completed scan of their registry (deleted repositories or
+# organizations no longer pruned) are removed by remove_unseen_entries.
+# The JSON file has the following structure:
+# {"version": 1, "repositories": {"<quay_host>/<org>/<repo>": {"parameters_hash": "...", "last_modified": ...,
+#                                                              "next_evaluation_ts": ..., "evaluated_ts": ...}}}
+
+INDEX_VERSION = 1
+RETRY_SECONDS = 3600
+
+enabled = False
+max_age_seconds = 7 * 24 * 3600
+entries = {}
+# Heap of the tuples (next_evaluation_ts, key). An item is stale if the entry of key has been updated or removed after
+# pushing it, the stale items are discarded when they are popped
+schedule = []
+due_keys = set()
+# Keys of the repositories listed since the last call of remove_unseen_entries
+seen_keys = set()
+index_lock = threading.Lock()
+
+
+def get_key(quay_host, organization, repository):
+    return f"{quay_host}/{organization}/{repository}"
+
+
+# Return the tuple (quay_host, organization, repository) of key
+def split_key(key):
+    quay_host, organization, repository = key.split("/", 2)
+    return quay_host, organization, repository
+
+
+def get_parameters_hash(parameters):
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Load the index from path (if the file exists) and pop the repositories to evaluate at current_ts
+def load(path, current_ts, max_age_days=7.0):
+    global enabled, max_age_seconds
+    enabled = True
+    max_age_seconds = max_age_days * 24 * 3600
+    loaded_entries = {}
+    if os.path.isfile(path):
+        with open(path, "r") as fp:
+            data = json.load(fp)
+        if data.get("version") == INDEX_VERSION:
+            loaded_entries = data["repositories"]
+
+    with index_lock:
+        entries.clear()
+        entries.update(loaded_entries)
+        seen_keys.clear()
+        rebuild_schedule()
+    refresh_due_keys(current_ts)
+
+
+# Rebuild the heap from the entries, discarding the stale items. It must be called holding index_lock
+def rebuild_schedule():
+    schedule[:] = [(entry["next_evaluation_ts"], key) for key, entry in entries.items()
+                   if entry["next_evaluation_ts"] is not None]
+    heapq.heapify(schedule)
+
+
+# Pop from the schedule and return the keys of the repositories whose next evaluation timestamp is lower or equal to
+# current_ts
+def pop_due(current_ts):
+    due = set()
+    with index_lock:
+        while schedule and schedule[0][0] <= current_ts:
+            next_evaluation_ts, key = heapq.heappop(schedule)
+            entry = entries.get(key)
+            if entry is not None and entry["next_evaluation_ts"] == next_evaluation_ts:
+                due.add(key)
+    return due
+
+
+# Add to the repositories evaluated by the next scan the repositories that reached their next evaluation timestamp
+def refresh_due_keys(current_ts):
+    due = pop_due(current_ts)
+    with index_lock:
+        due_keys.update(due)
+
+
+# Return the keys of the repositories that reached their next evaluation timestamp, including the repositories already
+# popped by load or refresh_due_keys and not evaluated yet. The returned repositories are no longer due for the scans
+def pop_scheduled(current_ts):
+    due = pop_due(current_ts)
+    with index_lock:
+        due.update(due_keys)
+        due_keys.clear()
+    return due
+
+
+# Schedule the evaluation of key at retry_ts. evaluated_ts is set to 0, so the scans evaluate the repository until an
+# evaluation is recorded. It must be called holding index_lock
+def schedule_retry(key, retry_ts):
+    entry = entries[key]
+    entry["next_evaluation_ts"] = retry_ts
+    entry["evaluated_ts"] = 0
+    heapq.heappush(schedule, (retry_ts, key))
+
+
+def write(path):
+    with index_lock:
+        data = json.dumps({"version": INDEX_VERSION, "repositories": entries}, separators=(",", ":"))
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as fp:
+        fp.write(data)
+    os.replace(temporary_path, path)
+
+
+# Return True if the repository must be evaluated. last_modified is the value returned by the repository listing.
+# The repository is marked as seen by the current scan of its registry
+def needs_evaluation(quay_host, organization, repository, parameters, last_modified, current_ts):
+    if not enabled:
+        return True
+    key = get_key(quay_host, organization, repository)
+    with index_lock:
+        seen_keys.add(key)
+        entry = entries.get(key)
+        is_due = key in due_keys
+    return entry is None \
+        or is_due \
+        or last_modified is None \
+        or entry["last_modified"] != last_modified \
+        or entry["parameters_hash"] != get_parameters_hash(parameters) \
+        or current_ts - entry["evaluated_ts"] >= max_age_seconds
+
+
+# Record the evaluation of a repository. If the evaluation failed (i.e. tag deletion errors) the repository is
+# scheduled again after RETRY_SECONDS (or at next_evaluation_ts if it is earlier)
+def record_evaluation(quay_host, organization, repository, parameters, last_modified, next_evaluation_ts,
+                      current_ts, succeeded=True):
+    if not enabled:
+        return
+    key = get_key(quay_host, organization, repository)
+    with index_lock:
+        due_keys.discard(key)
+        seen_keys.add(key)
+        # The pushed repositories pruned by the webhook receiver don't have the value last_modified of the listing: the
+        # previous value is kept, a push changes the value returned by the next listing anyway
+        if last_modified is None and key in entries:
+            last_modified = entries[key]["last_modified"]
+        entries[key] = {
+            "parameters_hash": get_parameters_hash(parameters),
+            "last_modified": last_modified,
+            "next_evaluation_ts": next_evaluation_ts,
+            "evaluated_ts": current_ts
+        }
+        if not succeeded:
+            schedule_retry(key, min(ts for ts in [next_evaluation_ts, current_ts + RETRY_SECONDS] if ts is not None))
+        elif next_evaluation_ts is not None:
+            heapq.heappush(schedule, (next_evaluation_ts, key))
+        # The stale items are discarded when the heap is much bigger than the index (long running webhook receiver)
+        if len(schedule) > 2 * len(entries) + 1024:
+            rebuild_schedule()
+
+
+# Schedule again the repository if no evaluation has been recorded since start_ts (the pruning raised an exception or
+# it ran in DRY_RUN), so a repository popped by pop_scheduled is not left out of the schedule
+def retry_if_not_recorded(quay_host, organization, repository, start_ts, current_ts):
+    if not enabled:
+        return
+    key = get_key(quay_host, organization, repository)
+    with index_lock:
+        entry = entries.get(key)
+        if entry is not None and entry["evaluated_ts"] < start_ts:
+            schedule_retry(key, current_ts + RETRY_SECONDS)
+
+
+# Remove the entries of the registries quay_hosts not seen since the previous call: the repositories that have not been
+# listed by a completed scan of their registry. The caller must pass only the registries whose scan has been completed
+def remove_unseen_entries(quay_hosts):
+    if not enabled:
+        return 0
+    with index_lock:
+        unseen_keys = [key for key in entries if split_key(key)[0] in quay_hosts and key not in seen_keys]
+        for key in unseen_keys:
+            del entries[key]
+            due_keys.discard(key)
+        seen_keys.clear()
+    return len(unseen_keys)
@@ -0,0 +1,92 @@
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+# Disable SSL Warnings
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# Names of the transports accepted by the environment variable QUAY_HTTP_TRANSPORT
+TRANSPORT_NAMES = ["requests", "http2"]
+
+
+# This exception is raised by the transports when the connection to the Quay registry fails, whatever HTTP library is
+# used by the transport
+class TransportConnectionError(Exception):
+    """Raised when a connection to the Quay registry can't be established"""
+    pass
+
+
+# Response returned by all the transports. It exposes only the attributes used by quayApi, so the rest of the
+# application doesn't depend on the HTTP library used by the transport
+class TransportResponse:
+    def __init__(self, status_code, reason, text, headers, json_body_loader):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+        self.headers = headers
+        self.json_body_loader = json_body_loader
+
+    def json(self):
+        return self.json_body_loader()
+
+
+# HTTP/1.1 transport based on the library requests. Each instance has its own connection pool
+class RequestsTransport:
+    # A connection sends a single request at a time
+    multiplexed = False
+
+    def __init__(self, verify=False, pool_maxsize=10):
+        self.verify = verify
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+
+    def request(self, method, url, headers, timeout):
+        try:
+            response = self.session.request(method, url, headers=headers, timeout=timeout, verify=self.verify)
+        except requests.ConnectionError as err:
+            raise TransportConnectionError(err) from err
+        return TransportResponse(response.status_code, response.reason, response.text, response.headers,
+                                 response.json)
+
+    def close(self):
+        self.session.close()
+
+
+# HTTP/2 transport based on the library httpx. The requests sent concurrently to the same registry are multiplexed
+# as streams over a few connections instead of opening one socket for each request
+class Http2Transport:
+    # The concurrent requests are sent as streams of the same connection
+    multiplexed = True
+
+    def __init__(self, verify=False, pool_maxsize=10, client=None):
+        # httpx is imported only when the HTTP/2 transport is selected
+        import httpx
+        self.httpx = httpx
+        if client is None:
+            client = httpx.Client(
+                http2=True,
+                verify=verify,
+                limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+            )
+        self.client = client
+
+    def request(self, method, url, headers, timeout):
+        try:
+            response = self.client.request(method, url, headers=headers, timeout=timeout)
+        # TransportError covers the errors opening the connection, the timeouts and the protocol errors (i.e. a
+        # connection reset or a stream reset by the registry while the requests are multiplexed)
+        except self.httpx.TransportError as err:
+            raise TransportConnectionError(err) from err
+        return TransportResponse(response.status_code, response.reason_phrase, response.text, response.headers,
+                                 response.json)
+
+    def close(self):
+        self.client.close()
+
+
+# Return a new transport. The value of verify is passed to the HTTP library: False disables the verification of the
+# registry TLS certificate, True verifies it using the system CA bundle, a string is the path of a CA bundle
+def create_transport(transport_name="requests", verify=False, pool_maxsize=10):
+    if transport_name == "http2":
+        return Http2Transport(verify, pool_maxsize)
+    return RequestsTransport(verify, pool_maxsize)
@@ -0,0 +1,136 @@
+import os
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Opt-in memory instrumentation (environment variable MEMORY_PROFILE).
+# For each measured scope (organization or repository) it records the peak of the memory traced by tracemalloc and the
+# RSS of the process at the end of the scope. For each organization it also records the call sites that allocated most
+# memory while the organization was pruned.
+# tracemalloc has a single process-wide peak counter, reset at the start of each scope. A thread resetting it while a
+# scope of another thread is open would erase the peak of that scope, so the measured scopes are serialized: a thread
+# opening its outermost scope waits until the scopes of the other threads are closed. When MEMORY_PROFILE is enabled
+# the registries are therefore pruned one organization at a time and the report states that the run was serialized:
+# the peak RSS of a run pruning the registries concurrently can be higher. The memory of the processes of the selection
+# pool (environment variable SELECTION_PROCESSES) is not traced.
+
+enabled = False
+top_n = 10
+measurements = {"organization": {}, "repository": {}}
+organization_top_allocations = {}
+measurements_lock = threading.Lock()
+# Held by a thread while it has at least one open scope
+scope_lock = threading.RLock()
+thread_data = threading.local()
+
+
+def start(top_allocations_number=10):
+    global enabled, top_n
+    enabled = True
+    top_n = top_allocations_number
+    tracemalloc.start()
+
+
+def stop():
+    global enabled
+    enabled = False
+    tracemalloc.stop()
+
+
+# Return the peak RSS of the process in bytes (ru_maxrss is expressed in kilobytes on Linux)
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Return the current RSS of the process in bytes, or None if /proc is not available
+def get_current_rss():
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Return a list of strings describing the top_n call sites that allocated more memory in the snapshot, compared with
+# the snapshot base_snapshot when it is defined
+def get_top_allocations(snapshot, base_snapshot=None):
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    if base_snapshot is None:
+        statistics = snapshot.statistics("lineno")
+        return [f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} size {stat.size} count {stat.count}"
+                for stat in statistics[:top_n]]
+    statistics = snapshot.compare_to(base_snapshot, "lineno")
+    return [f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} size_diff {stat.size_diff} "
+            f"count_diff {stat.count_diff}"
+            for stat in statistics[:top_n] if stat.size_diff > 0]
+
+
+# Context manager measuring the memory used by the scope kind ("organization" or "repository") named name.
+# The scopes can be nested: the peak of a scope includes the peaks of the scopes nested inside it
+@contextmanager
+def measure(kind, name):
+    if not enabled:
+        yield
+        return
+
+    stack = getattr(thread_data, "stack", None)
+    if stack is None:
+        stack = thread_data.stack = []
+
+    with scope_lock:
+        # tracemalloc has a single peak counter, the peak reached before resetting it is saved in the parent scope
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        base_snapshot = tracemalloc.take_snapshot() if kind == "organization" else None
+        scope = {"peak": 0}
+        stack.append(scope)
+        try:
+            yield
+        finally:
+            stack.pop()
+            scope["peak"] = max(scope["peak"], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], scope["peak"])
+            measurement = {"traced_peak": scope["peak"], "current_rss": get_current_rss()}
+            with measurements_lock:
+                measurements[kind][name] = measurement
+            if base_snapshot is not None:
+                top_allocations = get_top_allocations(tracemalloc.take_snapshot(), base_snapshot)
+                with measurements_lock:
+                    organization_top_allocations[name] = top_allocations
+
+
+def format_size(size):
+    if size is None:
+        return "n/a"
+    return f"{size / (1024 * 1024):.1f} MiB"
+
+
+# Return a multi-line human-readable string containing the memory measurements: the measurements of all the
+# organizations, the top_n repositories with the biggest traced peak and the top_n allocating call sites of the run
+def format_report():
+    lines = [f"Peak RSS of the process: {format_size(get_peak_rss())} (the organizations of all the registries have "
+             f"been pruned one at a time, the peak RSS of a run without MEMORY_PROFILE can be higher)"]
+
+    with measurements_lock:
+        organizations = dict(measurements["organization"])
+        repositories = dict(measurements["repository"])
+        top_allocations = dict(organization_top_allocations)
+
+    for name, measurement in sorted(organizations.items()):
+        lines.append(f"Organization {name}: traced peak {format_size(measurement['traced_peak'])}, "
+                     f"process RSS at the end {format_size(measurement['current_rss'])}")
+        for allocation in top_allocations.get(name, []):
+            lines.append(f"    {allocation}")
+
+    lines.append(f"Top {top_n} repositories by traced peak (of {len(repositories)} measured):")
+    for name, measurement in sorted(repositories.items(), key=lambda r: r[1]["traced_peak"], reverse=True)[:top_n]:
+        lines.append(f"    Repository {name}: traced peak {format_size(measurement['traced_peak'])}, "
+                     f"process RSS at the end {format_size(measurement['current_rss'])}")
+
+    lines.append(f"Top {top_n} allocating call sites still allocated at the end of the run:")
+    for allocation in get_top_allocations(tracemalloc.take_snapshot()):
+        lines.append(f"    {allocation}")
+    return "\n".join(lines)
@@ -1,10 +1,11 @@
-import requests
 import os
 import copy
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-
-# Disable SSL Warnings
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from prunerLib import httpTransport
+from prunerLib import responseCache
 
 # This exception is raise when the api call "https://{quay_host}/api/v1/superuser/organizations/" return the error
 # "status": 403 "error_message": "Unauthorized", "error_type": "insufficient_scope"
@@ -14,80 +15,172 @@ class ErrorAPIResponse403InsufficientScope(Exception):
     pass
 
 
+# This exception is raised when an API request returns an unexpected status code. The caller decides if the error
+# skips a single repository (i.e. status code 404 of a repository deleted after the listing of its organization) or
+# interrupts the pruning of the registry, the other registries are pruned anyway
+class ErrorAPIResponse(Exception):
+    def __init__(self, url, status_code, reason, text):
+        super().__init__(f"Error Quay API request to URL {url} has the status code {status_code}. The expected "
+                         f"status code is 200. API response reason: {reason} API response text: {text}")
+        self.status_code = status_code
+
+
+# Simple rate limiter used to space out the API requests sent to a single Quay registry.
+# A max_requests_per_second value of 0 disables the rate limit
+class RateLimiter:
+    def __init__(self, max_requests_per_second):
+        self.interval = 1.0 / max_requests_per_second if max_requests_per_second > 0 else 0.0
+        self.next_request_ts = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_request_ts - now
+            self.next_request_ts = max(now, self.next_request_ts) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# Each Quay registry has its own HTTP transport (and so its own connection pool) and its own rate limiter, so
+# registries pruned concurrently from the same process don't share connections or request budget
+registry_transports = {}
+registry_rate_limiters = {}
+registry_request_counters = {}
+# Executors sending concurrent requests to the registries whose transport multiplexes the requests (HTTP/2), so the
+# requests are in flight at the same time as streams of the same connection. At most pool_maxsize requests of a registry
+# are sent concurrently
+registry_executors = {}
+registry_lock = threading.Lock()
+
+
+def configure_registry(quay_host, max_requests_per_second=0.0, pool_maxsize=10, transport_name="requests",
+                       verify=False):
+    transport = httpTransport.create_transport(transport_name, verify, pool_maxsize)
+    executor = ThreadPoolExecutor(max_workers=pool_maxsize) if transport.multiplexed else None
+    with registry_lock:
+        if quay_host in registry_transports:
+            registry_transports[quay_host].close()
+        if registry_executors.get(quay_host) is not None:
+            registry_executors[quay_host].shutdown(wait=False)
+        registry_transports[quay_host] = transport
+        registry_rate_limiters[quay_host] = RateLimiter(max_requests_per_second)
+        registry_request_counters[quay_host] = 0
+        registry_executors[quay_host] = executor
+
+
+# Execute function(*args) in the executor of the registry quay_host and return its future, or return None if the
+# transport of the registry doesn't multiplex the requests (the caller executes the function in its own thread)
+def submit_request(quay_host, function, *args):
+    with registry_lock:
+        executor = registry_executors.get(quay_host)
+    if executor is None:
+        return None
+    return executor.submit(function, *args)
+
+
+def get_registry_transport(quay_host):
+    with registry_lock:
+        configured = quay_host in registry_transports
+    if not configured:
+        configure_registry(quay_host)
+    with registry_lock:
+        return registry_transports[quay_host], registry_rate_limiters[quay_host]
+
+
+# Return the number of API requests sent to the Quay registry quay_host since it has been configured
+def get_api_request_count(quay_host):
+    with registry_lock:
+        return registry_request_counters.get(quay_host, 0)
+
+
+# Send an API request to the Quay registry quay_host using the transport and the rate limiter of this registry
+def api_request(method, quay_host, url, headers, api_timeout):
+    transport, rate_limiter = get_registry_transport(quay_host)
+    with registry_lock:
+        registry_request_counters[quay_host] += 1
+    rate_limiter.wait()
+    return transport.request(method, url, headers, api_timeout)
+
+
+# Send a GET API request using the response cache (if enabled): the request is conditional when the response of the
+# same URL is cached, and a 304 response is returned as a 200 response with the cached body.
+# The requests whose URL can't be sent again by the next executions (cacheable False) bypass the cache
+def cached_api_get(quay_host, url, headers, api_timeout, cacheable=True):
+    if not responseCache.enabled or not cacheable:
+        return api_request("GET", quay_host, url, headers, api_timeout)
+
+    key = responseCache.get_key(url, headers["Authorization"])
+    entry = responseCache.lookup(key)
+    request_headers = dict(headers)
+    if entry is not None:
+        request_headers.update(responseCache.get_conditional_headers(entry))
+    response = api_request("GET", quay_host, url, request_headers, api_timeout)
+
+    if response.status_code == 304 and entry is not None:
+        responseCache.record_request(quay_host, True)
+        body = entry["body"]
+        return httpTransport.TransportResponse(200, "OK", body, response.headers, lambda: json.loads(body))
+    responseCache.record_request(quay_host, False)
+    if response.status_code == 200:
+        responseCache.store(key, url, response.headers, response.text)
+    return response
+
+
 def get_orgs_json(logger, quay_host, app_token, api_timeout):
     base_url = f"https://{quay_host}/api/v1/superuser/organizations/"
     get_headers = {'accept': 'application/json', 'Authorization': 'Bearer '+ app_token }
     try:
         logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                      "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-        response = requests.get(
-            base_url,
-            headers=get_headers,
-            timeout=api_timeout,
-            verify=False
-        )
+        response = api_request("GET", quay_host, base_url, get_headers, api_timeout)
         logger.debug(f"API Response: {response.json()}")
 
         if response.status_code == 403 and response.json()["error_message"] == "Unauthorized" and \
            response.json()["error_type"] == "insufficient_scope":
             raise ErrorAPIResponse403InsufficientScope
         elif response.status_code != 200:
-            logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                             f"API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-            os._exit(1)
+            raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
 
-    except requests.ConnectionError as err:
+    except httpTransport.TransportConnectionError as err:
         logger.exception(f"Connection error: {err}")
     else:
         return response.json()
 
 def get_repo_list_json(logger, quay_host, app_token, api_timeout, quay_org):
-    base_url = f"https://{quay_host}/api/v1/repository?namespace={quay_org}"
+    # last_modified=true adds to each repository the timestamp of its last push (used by the expiry index)
+    base_url = f"https://{quay_host}/api/v1/repository?namespace={quay_org}&last_modified=true"
     get_headers = {'accept': 'application/json', 'Authorization': 'Bearer '+ app_token }
     try:
         logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                      "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-        response = requests.get(
-            base_url,
-            headers=get_headers,
-            timeout=api_timeout,
-            verify=False
-        )
+        response = cached_api_get(quay_host, base_url, get_headers, api_timeout)
 
 
         if response.status_code != 200:
-            logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                             f"API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-            os._exit(1)
+            raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
         logger.debug(f"API Response: {response.json()}")
         result = response.json()
 
         # Manage organization with more than 100 repositories using pagination
         while 'next_page' in response.json().keys():
             next_page = response.json()["next_page"]
-            base_url = f"https://{quay_host}/api/v1/repository?namespace={quay_org}&next_page={next_page}"
+            base_url = (f"https://{quay_host}/api/v1/repository?namespace={quay_org}&last_modified=true"
+                        f"&next_page={next_page}")
 
             logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                          "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-            response = requests.get(
-                base_url,
-                headers=get_headers,
-                timeout=api_timeout,
-                verify=False
-            )
-            logger.debug(f"API Response: {response.json()}")
-
+            # The token next_page is opaque and changes at each listing, the response can't be reused
+            response = cached_api_get(quay_host, base_url, get_headers, api_timeout, cacheable=False)
             if response.status_code != 200:
-                logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                                 f"API response reason: {response.reason}\n"
-                                 f"API response text: {response.text}")
-                os._exit(1)
+                raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
+            logger.debug(f"API Response: {response.json()}")
 
             result["repositories"].extend(copy.deepcopy(response.json()["repositories"]))
 
-    except requests.ConnectionError as err:
+    except httpTransport.TransportConnectionError as err:
         logger.exception(f"Connection error: {err}")
     else:
         return result
@@ -100,21 +193,12 @@ def get_repo_json(logger, quay_host, app_token, api_timeout, quay_org, image):
     try:
         logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                      "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-        response = requests.get(
-            base_url,
-            headers=get_headers,
-            timeout=api_timeout,
-            verify=False
-        )
-        logger.debug(f"API Response: {response.json()}")
-
+        response = cached_api_get(quay_host, base_url, get_headers, api_timeout)
         if response.status_code != 200:
-            logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                             f"API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-            os._exit(1)
+            raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
+        logger.debug(f"API Response: {response.json()}")
         result = response.json()
-    except requests.ConnectionError as err:
+    except httpTransport.TransportConnectionError as err:
         logger.exception(f"Connection error: {err}")
     else:
         return result
@@ -127,19 +211,10 @@ def get_tags_json(logger, quay_host, app_token, api_timeout, quay_org, image):
     try:
         logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                      "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-        response = requests.get(
-            base_url,
-            headers=get_headers,
-            timeout=api_timeout,
-            verify=False
-        )
-        logger.debug(f"API Response: {response.json()}")
-
+        response = cached_api_get(quay_host, base_url, get_headers, api_timeout)
         if response.status_code != 200:
-            logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                             f"API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-            os._exit(1)
+            raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
+        logger.debug(f"API Response: {response.json()}")
         result = response.json()
 
         # Manage repository with more than 50 tags using pagination
@@ -149,61 +224,54 @@ def get_tags_json(logger, quay_host, app_token, api_timeout, quay_org, image):
 
             logger.debug(f"Invoke API Request Type: GET URL:{base_url} with the following headers: "
                          "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-            response = requests.get(
-                base_url,
-                headers=get_headers,
-                timeout=api_timeout,
-                verify=False
-            )
-            logger.debug(f"API Response: {response.json()}")
-
+            response = cached_api_get(quay_host, base_url, get_headers, api_timeout)
             if response.status_code != 200:
-                logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}. The expected status code is 200.\n"
-                             f"API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-                os._exit(1)
+                raise ErrorAPIResponse(base_url, response.status_code, response.reason, response.text)
+            logger.debug(f"API Response: {response.json()}")
             result["tags"].extend(copy.deepcopy(response.json()["tags"]))
 
-    except requests.ConnectionError as err:
+    except httpTransport.TransportConnectionError as err:
         logger.exception(f"Connection error: {err}")
     else:
         return result
 
 
-# This function returns an empty list if there aren't errors during tag deletion API Request
-# Otherwise it returns a list of strings containing a human-readable message describing the API Response errors
-def delete_tags(logger, quay_host, app_token, api_timeout, quay_org, image, tags):
-    delete_tag_error_list = []
-
+# Delete a single tag. It returns None if the tag has been deleted (or it had already been deleted), otherwise it
+# returns a string containing a human-readable message describing the API Response error
+def delete_tag(logger, quay_host, app_token, api_timeout, quay_org, image, tag):
     base_url = f"https://{quay_host}/api/v1/repository/{quay_org}/{image}/tag"
     get_headers = {'accept': 'application/json', 'Authorization': 'Bearer '+ app_token }
-    for tag in tags:
-        logger.debug(f"Invoke API Request Type: DELETE URL:{base_url} tag {tag['name']} with the following headers: "
-                     "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
-        response = requests.delete(
-            f"{base_url}/{tag['name']}",
-            headers=get_headers,
-            timeout=api_timeout,
-            verify=False
+    logger.debug(f"Invoke API Request Type: DELETE URL:{base_url} tag {tag['name']} with the following headers: "
+                 "{'accept': 'application/json', 'Authorization': 'Bearer <QUAY_TOKEN_OBFUSCATED> }")
+    response = api_request("DELETE", quay_host, f"{base_url}/{tag['name']}", get_headers, api_timeout)
+    logger.debug(f"API Response status code: {response.status_code} reason: {response.reason} "
+                 f"text: {response.text}")
+
+    if response.status_code == 400:
+        logger.info(
+            f"{quay_org}/{image}:{tag['name']} has already been deleted"
         )
-        logger.debug(f"API Response {vars(response)}")
-
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as err:
-            if response.status_code == 400:
-                logger.info(
-                    f"{quay_org}/{image}:{tag['name']} has already been deleted"
-                )
-            else:
-                logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}.\n"
-                             f"The expected status code is 200. API response reason: {response.reason}\n"
-                             f"API response text: {response.text}")
-                delete_tag_error_list.append(
-                    f"Error occurred deleting tags {tag['name']} of {quay_org}/{image} Status code API response: "
-                    f"{response.status_code} API response reason: {response.reason} API response text: {response.text}")
+    elif response.status_code >= 400:
+        logger.error(f"Error Quay API request to URL {base_url} has the status code {response.status_code}.\n"
+                     f"The expected status code is 200. API response reason: {response.reason}\n"
+                     f"API response text: {response.text}")
+        return (f"Error occurred deleting tags {tag['name']} of {quay_org}/{image} Status code API response: "
+                f"{response.status_code} API response reason: {response.reason} API response text: {response.text}")
+    else:
+        logger.info(f"{quay_org}/{image}:{tag['name']} deleted")
+    return None
 
-        else:
-            logger.info(f"{quay_org}/{image}:{tag['name']} deleted")
 
-    return delete_tag_error_list
+# This function returns an empty list if there aren't errors during tag deletion API Request
+# Otherwise it returns a list of strings containing a human-readable message describing the API Response errors
+# If the transport of the registry multiplexes the requests (HTTP/2), the tags are deleted concurrently
+def delete_tags(logger, quay_host, app_token, api_timeout, quay_org, image, tags):
+    futures = [submit_request(quay_host, delete_tag, logger, quay_host, app_token, api_timeout, quay_org, image, tag)
+               for tag in tags]
+    results = []
+    for tag, future in zip(tags, futures):
+        if future is None:
+            results.append(delete_tag(logger, quay_host, app_token, api_timeout, quay_org, image, tag))
+        else:
+            results.append(future.result())
+    return [error for error in results if error is not None]
@@ -0,0 +1,90 @@
+import gzip
+import json
+import threading
+import time
+
+# Export of the tag metadata gathered during a crawl (environment variable SNAPSHOT_EXPORT_FILE).
+# The snapshot is a gzip compressed JSON document with the following structure:
+# {
+#   "version": 1,
+#   "exported_ts": <timestamp of the crawl>,
+#   "registries": {
+#     "<quay_url>": {
+#       "<organization>": {
+#         "<repository>": [["<tag name>", <start_ts>, <size>], ...]
+#       }
+#     }
+#   },
+#   "organizations": {
+#     "<quay_url>": ["<organization>", ...]
+#   }
+# }
+# Only the tag attributes used by the tag selection are exported, so the snapshot of a big registry stays compact.
+# Each organization listed during the crawl is present in "registries" also if it has no repository. "organizations"
+# contains the list of all the organizations of a registry, it is exported only if the default rule is enabled (the
+# simulator applies the default rule of a candidate configuration to this list).
+
+SNAPSHOT_VERSION = 1
+
+enabled = False
+snapshot = {"version": SNAPSHOT_VERSION, "exported_ts": 0, "registries": {}, "organizations": {}}
+snapshot_lock = threading.Lock()
+
+
+def start_export():
+    global enabled
+    enabled = True
+    snapshot["exported_ts"] = int(time.time())
+
+
+# Record an organization whose repositories have been listed, so the organizations without repositories are present in
+# the snapshot
+def record_organization(quay_host, organization):
+    if not enabled:
+        return
+    with snapshot_lock:
+        snapshot["registries"].setdefault(quay_host, {}).setdefault(organization, {})
+
+
+# Record the list of all the organizations of a registry returned by pruner.get_orgs_list
+def record_organization_list(quay_host, org_list):
+    if not enabled:
+        return
+    with snapshot_lock:
+        snapshot["organizations"][quay_host] = sorted(org_list)
+
+
+# Record the tags of a repository returned by quayApi.get_tags_json. Only the first call for each repository is
+# recorded, so the snapshot contains the tags of the repository before the deletion of any tag
+def record_repository(quay_host, organization, repository, tags):
+    if not enabled:
+        return
+    compact_tags = [[tag["name"], tag["start_ts"], tag.get("size") or 0] for tag in tags["tags"]]
+    with snapshot_lock:
+        organizations = snapshot["registries"].setdefault(quay_host, {})
+        repositories = organizations.setdefault(organization, {})
+        repositories.setdefault(repository, compact_tags)
+
+
+def write(path):
+    with snapshot_lock:
+        data = json.dumps(snapshot, separators=(",", ":"))
+    with gzip.open(path, "wt", encoding="utf-8") as fp:
+        fp.write(data)
+
+
+def load(path):
+    with gzip.open(path, "rt", encoding="utf-8") as fp:
+        data = json.load(fp)
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"The snapshot {path} has the version {data.get('version')}, the supported version is "
+                         f"{SNAPSHOT_VERSION}")
+    # The snapshots exported before the key "organizations" was added don't contain the lists of organizations
+    data.setdefault("organizations", {})
+    return data
+
+
+# Convert the compact tags of a repository of the snapshot to the format returned by quayApi.get_tags_json
+def expand_tags(compact_tags):
+    return {"tags": [{"name": name, "start_ts": start_ts, "size": size, "last_modified": ""}
+                     for name, start_ts, size in compact_tags]}
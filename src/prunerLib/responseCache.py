@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Disk cache of the responses of the Quay API GET requests listing repositories and tags (environment variable
+# QUAY_RESPONSE_CACHE_DIR).
+# Each response returned with a validator (header ETag or Last-Modified) is stored in a JSON file of the cache
+# directory together with its validators. The next request to the same URL with the same token is sent as a
+# conditional request (headers If-None-Match and If-Modified-Since): if the registry answers 304 Not Modified, the
+# body is read from the cache instead of being rendered and transferred again. The responses without validators are
+# not cached and their requests are sent as plain requests.
+# The size of the cache directory is bounded by max_bytes: the least recently used entries are removed first. The
+# recency of an entry is the modification time of its file, so it is preserved between the executions.
+# Each file has the following structure:
+# {"url": "...", "etag": "..." or null, "last_modified": "..." or null, "body": "<text of the response>"}
+
+enabled = False
+directory = None
+max_bytes = 100 * 1024 * 1024
+# key -> size of the file of the entry, ordered from the least to the most recently used entry
+entry_sizes = OrderedDict()
+total_bytes = 0
+# quay_host -> {"hits": ..., "misses": ...}
+counters = {}
+cache_lock = threading.Lock()
+
+
+def configure(cache_directory, max_size_mb=100.0):
+    global enabled, directory, max_bytes, total_bytes
+    os.makedirs(cache_directory, exist_ok=True)
+    entries = []
+    for file_name in os.listdir(cache_directory):
+        if not file_name.endswith(".json"):
+            continue
+        stat = os.stat(os.path.join(cache_directory, file_name))
+        entries.append((stat.st_mtime, file_name[:-len(".json")], stat.st_size))
+
+    with cache_lock:
+        enabled = True
+        directory = cache_directory
+        max_bytes = int(max_size_mb * 1024 * 1024)
+        entry_sizes.clear()
+        for _, key, size in sorted(entries):
+            entry_sizes[key] = size
+        total_bytes = sum(entry_sizes.values())
+        evict()
+
+
+# The token is part of the key because the content of the responses depends on the permissions of the token
+def get_key(url, authorization):
+    return hashlib.sha256(f"{authorization}\n{url}".encode("utf-8")).hexdigest()
+
+
+def get_path(key):
+    return os.path.join(directory, f"{key}.json")
+
+
+# Return the cached entry of key or None. The entry becomes the most recently used entry
+def lookup(key):
+    with cache_lock:
+        if key not in entry_sizes:
+            return None
+        entry_sizes.move_to_end(key)
+    try:
+        with open(get_path(key), "r") as fp:
+            entry = json.load(fp)
+        os.utime(get_path(key))
+    except (OSError, ValueError):
+        remove(key)
+        return None
+    return entry
+
+
+# Return the conditional request headers built from the validators of the cached entry
+def get_conditional_headers(entry):
+    headers = {}
+    if entry["etag"] is not None:
+        headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"] is not None:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+# Store the body of a response with its validators. A response without validators can't be revalidated, so it is not
+# stored and the previous entry of the same key (if any) is removed
+def store(key, url, response_headers, body):
+    etag = response_headers.get("ETag")
+    last_modified = response_headers.get("Last-Modified")
+    if etag is None and last_modified is None:
+        remove(key)
+        return
+
+    data = json.dumps({"url": url, "etag": etag, "last_modified": last_modified, "body": body})
+    path = get_path(key)
+    temporary_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as fp:
+        fp.write(data)
+    os.replace(temporary_path, path)
+
+    global total_bytes
+    with cache_lock:
+        total_bytes += len(data) - entry_sizes.pop(key, 0)
+        entry_sizes[key] = len(data)
+        evict()
+
+
+def remove(key):
+    global total_bytes
+    with cache_lock:
+        if key not in entry_sizes:
+            return
+        total_bytes -= entry_sizes.pop(key)
+    try:
+        os.remove(get_path(key))
+    except FileNotFoundError:
+        pass
+
+
+# Remove the least recently used entries until the size of the cache is lower or equal to max_bytes.
+# It must be called holding cache_lock
+def evict():
+    global total_bytes
+    while total_bytes > max_bytes and entry_sizes:
+        key, size = entry_sizes.popitem(last=False)
+        total_bytes -= size
+        try:
+            os.remove(get_path(key))
+        except FileNotFoundError:
+            pass
+
+
+def record_request(quay_host, hit):
+    with cache_lock:
+        registry_counters = counters.setdefault(quay_host, {"hits": 0, "misses": 0})
+        registry_counters["hits" if hit else "misses"] += 1
+
+
+# Return the number of cache hits (304 responses) and misses of the requests sent to the Quay registry quay_host
+def get_counters(quay_host):
+    with cache_lock:
+        return dict(counters.get(quay_host, {"hits": 0, "misses": 0}))
@@ -0,0 +1,94 @@
+import re
+
+# Tag selection functions without side effects (no logging, no API requests).
+# They are used by pruner.select_tags_to_remove (which only adds the debug messages) and by the processes of the
+# selection pool (environment variable SELECTION_PROCESSES), which receive only the compact tags (name, start_ts) of a
+# repository and return the names of the tags to delete.
+
+
+# Return the tags whose name matches the regular expression tag_filter
+def match_tags(tags, tag_filter):
+    search = re.compile(tag_filter).search
+    return [tag for tag in tags if search(tag["name"])]
+
+
+# Return the matched tags that are not among the keep_n_tags most recent tags
+def select_by_keep_n_tags(matches, keep_n_tags):
+    if len(matches) <= keep_n_tags:
+        return []
+    sorted_matches = sorted(matches, key=lambda t: t["start_ts"])
+    return sorted_matches[0:len(matches) - keep_n_tags]
+
+
+# Return the matched tags older than keep_tags_younger_than days
+def select_by_keep_tags_younger_than(matches, keep_tags_younger_than, current_ts):
+    # the unit of measure of keep_tags_younger_than is days,keep_tags_younger_than_seconds convert it in seconds
+    keep_tags_younger_than_seconds = keep_tags_younger_than * 24 * 3600
+    return [tag for tag in matches if (current_ts - tag["start_ts"]) > keep_tags_younger_than_seconds]
+
+
+# Return the tags selected by both the conditions keep_n_tags and keep_tags_younger_than
+def intersect_selections(tag_deleted_by_keep_tag_number, tag_deleted_by_keep_tags_younger_than):
+    tag_names_deleted_by_keep_tags_younger_than = set(tag['name'] for tag in tag_deleted_by_keep_tags_younger_than)
+    return [tag for tag in tag_deleted_by_keep_tag_number
+            if tag['name'] in tag_names_deleted_by_keep_tags_younger_than]
+
+
+# Return the tags to remove based on a single pruning parameter
+def select_tags(tags, parameter, current_ts):
+    matches = match_tags(tags, parameter["tag_filter"])
+    if "keep_n_tags" in parameter.keys():
+        result = select_by_keep_n_tags(matches, int(parameter["keep_n_tags"]))
+        if "keep_tags_younger_than" in parameter.keys():
+            result = intersect_selections(
+                result,
+                select_by_keep_tags_younger_than(matches, int(parameter["keep_tags_younger_than"]), current_ts)
+            )
+        return result
+    return select_by_keep_tags_younger_than(matches, int(parameter["keep_tags_younger_than"]), current_ts)
+
+
+# Apply the parameters in order to the tags: the tags selected by a parameter are not evaluated by the next
+# parameters. select(tags, parameter) returns the tags selected by a single parameter, by default select_tags.
+# It returns the list of all the tags selected to be removed
+def select_tags_in_order(tags, parameters, current_ts, select=None):
+    if select is None:
+        def select(remaining_tags, parameter):
+            return select_tags(remaining_tags, parameter, current_ts)
+    remaining_tags = tags
+    result = []
+    for parameter in parameters:
+        bad_tags = select(remaining_tags, parameter)
+        bad_tag_names = set(tag["name"] for tag in bad_tags)
+        result.extend(bad_tags)
+        remaining_tags = [tag for tag in remaining_tags if tag["name"] not in bad_tag_names]
+    return result
+
+
+# Function executed by the processes of the selection pool. compact_tags is a list of tuples (name, start_ts).
+# It returns the list of the names of the tags to remove
+def select_tag_names_to_remove(compact_tags, parameters, current_ts):
+    tags = [{"name": name, "start_ts": start_ts} for name, start_ts in compact_tags]
+    return [tag["name"] for tag in select_tags_in_order(tags, parameters, current_ts)]
+
+
+# Return the first timestamp at which the selection of the parameters on the tags can change without pushes (a tag
+# becomes older than keep_tags_younger_than days), or None if the selection changes only when tags are pushed.
+# tags must be the tags left in the repository after the deletion of the tags selected by the parameters: all the
+# matched tags kept because of keep_tags_younger_than are younger than the limit
+def get_next_selection_change_ts(tags, parameters):
+    next_change_ts = None
+    for parameter in parameters:
+        if "keep_tags_younger_than" not in parameter.keys():
+            continue
+        matches = match_tags(tags, parameter["tag_filter"])
+        # With keep_n_tags, only the tags that are not among the keep_n_tags most recent tags can be deleted
+        if "keep_n_tags" in parameter.keys():
+            matches = select_by_keep_n_tags(matches, int(parameter["keep_n_tags"]))
+        if matches == []:
+            continue
+        keep_tags_younger_than_seconds = int(parameter["keep_tags_younger_than"]) * 24 * 3600
+        change_ts = min(tag["start_ts"] for tag in matches) + keep_tags_younger_than_seconds + 1
+        if next_change_ts is None or change_ts < next_change_ts:
+            next_change_ts = change_ts
+    return next_change_ts
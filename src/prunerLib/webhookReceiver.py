@@ -0,0 +1,173 @@
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Receiver of the Quay "Push to Repository" notifications (webhook method).
+# Each notification queues the pushed repository (registry, organization, repository). A single worker thread prunes
+# the repositories that haven't received other pushes for debounce_seconds, so a burst of pushes to the same repository
+# is pruned only once, and the repositories pushed continuously after MAX_WAIT_DEBOUNCE_INTERVALS debounce intervals.
+# The same worker thread periodically runs a full sweep of the registries as a safety net for the missed notifications
+# and for the tags crossing the keep_tags_younger_than boundary without pushes.
+# The repository-push notification payload sent by Quay contains the following keys used by the receiver:
+# {"repository": "<org>/<repo>", "namespace": "<org>", "name": "<repo>", "docker_url": "<quay_host>/<org>/<repo>"}
+# The notifications are accepted only if the URL of the request contains the query parameter token with the value of
+# the environment variable WEBHOOK_TOKEN, which is required in webhook receiver mode.
+
+
+# A repository receiving pushes continuously is pruned anyway after this number of debounce intervals from its first
+# queued push
+MAX_WAIT_DEBOUNCE_INTERVALS = 4
+
+
+# Queue of the pushed repositories. A repository is present only once in the queue, a new push of a queued repository
+# postpones its pruning up to max_wait_seconds after the first push
+class PushQueue:
+    def __init__(self):
+        # (quay_host, organization, repository) -> (timestamp of the first push, timestamp of the last push)
+        self.pushes = {}
+        self.lock = threading.Lock()
+
+    def push(self, quay_host, organization, repository):
+        key = (quay_host, organization, repository)
+        now = time.monotonic()
+        with self.lock:
+            first_push_ts = self.pushes[key][0] if key in self.pushes else now
+            self.pushes[key] = (first_push_ts, now)
+
+    # Remove from the queue and return the repositories that haven't received pushes for debounce_seconds or that have
+    # been queued for max_wait_seconds (by default MAX_WAIT_DEBOUNCE_INTERVALS debounce intervals)
+    def pop_due(self, debounce_seconds, max_wait_seconds=None):
+        if max_wait_seconds is None:
+            max_wait_seconds = MAX_WAIT_DEBOUNCE_INTERVALS * debounce_seconds
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, (first_push_ts, last_push_ts) in self.pushes.items()
+                   if now - last_push_ts >= debounce_seconds or now - first_push_ts >= max_wait_seconds]
+            for key in due:
+                del self.pushes[key]
+        return due
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pushes)
+
+
+# Return the tuple (quay_host, organization, repository) described by the notification payload, or None if the
+# payload is not a repository notification
+def parse_push_payload(payload):
+    if not isinstance(payload, dict):
+        return None
+    organization = payload.get("namespace")
+    repository = payload.get("name")
+    if (not organization or not repository) and isinstance(payload.get("repository"), str) \
+            and "/" in payload["repository"]:
+        organization, repository = payload["repository"].split("/", 1)
+    if not isinstance(organization, str) or not isinstance(repository, str) or not organization or not repository:
+        return None
+    quay_host = None
+    if isinstance(payload.get("docker_url"), str) and "/" in payload["docker_url"]:
+        quay_host = payload["docker_url"].split("/", 1)[0]
+    return quay_host, organization, repository
+
+
+# Return True if the query parameter token of the request path is equal to token. The comparison time doesn't depend on
+# the position of the first different character, so the token can't be guessed measuring the response times
+def is_token_valid(path, token):
+    request_tokens = parse_qs(urlparse(path).query).get("token", [])
+    return len(request_tokens) == 1 and hmac.compare_digest(request_tokens[0].encode("utf-8"), token.encode("utf-8"))
+
+
+def create_request_handler(logger, push_queue, token):
+    class PushNotificationHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not is_token_valid(self.path, token):
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+            except (ValueError, UnicodeDecodeError):
+                payload = None
+            pushed_repository = parse_push_payload(payload)
+            if pushed_repository is None:
+                logger.warning(f"Webhook notification ignored, the payload is not a repository notification: "
+                               f"{payload}")
+                self.send_response(400)
+                self.end_headers()
+                return
+            push_queue.push(*pushed_repository)
+            logger.info(f"Webhook notification received for the repository {pushed_repository}")
+            self.send_response(202)
+            self.end_headers()
+
+        def do_GET(self):
+            # Health check
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(f"Webhook receiver request from {self.address_string()}: {format % args}")
+
+    return PushNotificationHandler
+
+
+# Worker executed in a dedicated thread: it calls prune_repository(quay_host, organization, repository) for each
+# repository of the queue, after the debounce time, and full_sweep() every full_sweep_interval_seconds.
+# The first full sweep is executed full_sweep_interval_seconds after the start of the receiver.
+# If pop_scheduled_repositories is defined, it returns the list of the tuples (quay_host, organization, repository)
+# that must be pruned without a push (expiry index), they are added to the queue
+def run_worker(logger, push_queue, prune_repository, full_sweep, debounce_seconds, full_sweep_interval_seconds,
+               stop_event, poll_seconds=1.0, pop_scheduled_repositories=None):
+    next_full_sweep_ts = time.monotonic() + full_sweep_interval_seconds
+    while not stop_event.is_set():
+        if pop_scheduled_repositories is not None:
+            scheduled_repositories = pop_scheduled_repositories()
+            if scheduled_repositories:
+                logger.info(f"{len(scheduled_repositories)} repositories scheduled by the expiry index added to the "
+                            f"queue")
+            for scheduled_repository in scheduled_repositories:
+                push_queue.push(*scheduled_repository)
+
+        if time.monotonic() >= next_full_sweep_ts:
+            logger.info("Start the periodic full sweep of the registries")
+            try:
+                full_sweep()
+            except Exception:
+                logger.exception("Error during the periodic full sweep of the registries")
+            next_full_sweep_ts = time.monotonic() + full_sweep_interval_seconds
+
+        for quay_host, organization, repository in push_queue.pop_due(debounce_seconds):
+            try:
+                prune_repository(quay_host, organization, repository)
+            except Exception:
+                logger.exception(f"Error pruning the repository {organization}/{repository} of the registry "
+                                 f"{quay_host}")
+
+        stop_event.wait(poll_seconds)
+
+
+# Start the receiver listening on port and its worker thread. The function blocks until the receiver is stopped
+def serve(logger, port, token, prune_repository, full_sweep, debounce_seconds, full_sweep_interval_seconds,
+          pop_scheduled_repositories=None):
+    push_queue = PushQueue()
+    stop_event = threading.Event()
+    worker = threading.Thread(
+        target=run_worker,
+        args=(logger, push_queue, prune_repository, full_sweep, debounce_seconds, full_sweep_interval_seconds,
+              stop_event, 1.0, pop_scheduled_repositories),
+        daemon=True
+    )
+    worker.start()
+
+    server = ThreadingHTTPServer(("", port), create_request_handler(logger, push_queue, token))
+    logger.info(f"Webhook receiver listening on port {port}, debounce {debounce_seconds} seconds, full sweep every "
+                f"{full_sweep_interval_seconds} seconds")
+    try:
+        server.serve_forever()
+    finally:
+        stop_event.set()
+        server.server_close()
@@ -0,0 +1,69 @@
+import re
+
+# The work planner resolves the rules and the default rule of the configuration file into a single work plan:
+# a dictionary organization -> list of pruning parameters. Each organization is present only once in the plan, so its
+# repositories and tags are listed and fetched only once for each execution, even when the organization is defined in
+# several rules or more than once in the same rule.
+# The parameters of an organization are ordered as the rules of the configuration file: pruner.py applies them in this
+# order to the tags of each repository, and the tags selected by a parameter are not evaluated by the next ones.
+
+
+# Append the parameters to the list of parameters of the organization, skipping the parameters already present.
+# Applying again the same parameter to the tags left by a previous application of it doesn't select other tags
+def add_parameters(plan, organization, parameters):
+    organization_parameters = plan.setdefault(organization, [])
+    for parameter in parameters:
+        if parameter not in organization_parameters:
+            organization_parameters.append(parameter)
+
+
+# This function returns the organizations of org_list pruned by the default rule: the organizations not matching the
+# regular expression exclude_organizations_regex and not defined in the organization_list of the rules
+def get_default_rule_organizations(logger, conf_yaml, org_list):
+    rules_organizations = set(str(org) for rule in conf_yaml["rules"] for org in rule["organization_list"])
+
+    # If the parameter exclude_organizations_regex is an empty string, it doesn't exclude any organization
+    exclude_organizations_regex = conf_yaml['default_rule']['exclude_organizations_regex']
+    if exclude_organizations_regex != "":
+        exclude_organizations_filter_regex = re.compile(exclude_organizations_regex)
+        org_exclude_list = [org for org in org_list if exclude_organizations_filter_regex.match(org)]
+    else:
+        org_exclude_list = []
+    logger.debug(f"Organizations excluded using the configuration file parameter exclude_organizations_regex "
+                 f"list: {org_exclude_list}")
+
+    org_exclude_set = rules_organizations.union(org_exclude_list)
+    return [org for org in org_list if org not in org_exclude_set]
+
+
+# Return the work plan of the configuration file conf_yaml (a dictionary containing the keys rules and default_rule).
+# org_list is the list of all the organizations of the registry, it is used only if the default rule is enabled
+def plan_organizations(logger, conf_yaml, org_list=None):
+    plan = {}
+    for rule in conf_yaml["rules"]:
+        for organization in rule["organization_list"]:
+            add_parameters(plan, str(organization), rule["parameters"])
+
+    if conf_yaml["default_rule"]["enabled"]:
+        org_default_list = get_default_rule_organizations(logger, conf_yaml, org_list)
+        logger.info(f"Organizations pruned by default_rule: {org_default_list}")
+        for organization in org_default_list:
+            add_parameters(plan, organization, conf_yaml["default_rule"]["parameters"])
+
+    return plan
+
+
+# Return the list of pruning parameters of a single organization, or None if the organization is not pruned (it is not
+# defined in the rules and it is excluded by the default rule or the default rule is disabled)
+def get_organization_parameters(logger, conf_yaml, organization):
+    return plan_organizations(logger, conf_yaml, [organization]).get(organization)
+
+
+# Return the minimum number of API requests expected to list the repositories of the organizations of the work plan:
+# the request listing the organizations (only if the default rule is enabled) and one request for each organization.
+# pruner.py adds two requests for each repository (repository state and first page of tags) after the listing of the
+# repositories of an organization. The pagination of repositories and tags and the tag deletions add more requests
+def count_expected_api_calls(plan, default_rule_enabled):
+    api_calls = 1 if default_rule_enabled else 0
+    api_calls += len(plan)
+    return api_calls
@@ -0,0 +1,109 @@
+import argparse
+import logging
+import os
+import yaml
+import pruner
+from prunerLib import checkConfiguration
+from prunerLib import registrySnapshot
+from prunerLib import workPlanner
+
+# Offline what-if simulator: it applies a candidate configuration file to a snapshot exported by pruner.py (environment
+# variable SNAPSHOT_EXPORT_FILE) and reports, for each organization, the tags and the bytes that would be deleted.
+# The tags are selected with the same functions used by pruner.py, no Quay API request is sent.
+
+
+# This function returns a dictionary with the number of repositories, tags, tags deleted and bytes deleted of the
+# organization when the list of pruning parameters is applied to the repositories of the snapshot
+def simulate_organization(organization, repositories, parameters, current_ts):
+    result = {"repositories": len(repositories), "tags": 0, "tags_deleted": 0, "bytes_deleted": 0}
+    for repository, compact_tags in repositories.items():
+        tags = registrySnapshot.expand_tags(compact_tags)
+        bad_tags = pruner.select_repository_tags_to_remove(organization, repository, tags, parameters, current_ts)
+        result["tags"] += len(compact_tags)
+        result["tags_deleted"] += len(bad_tags)
+        result["bytes_deleted"] += sum(tag["size"] for tag in bad_tags)
+    return result
+
+
+# This function applies the rules and the default rule defined in conf_yaml to the organizations of a registry of the
+# snapshot, using the same work plan of pruner.py. org_list is the list of all the organizations of the registry used by
+# the default rule, if it is None the default rule is applied to the organizations of the snapshot. It returns a
+# dictionary organization -> result of simulate_organization and the list of the organizations of the work plan
+# missing from the snapshot
+def simulate_registry(conf_yaml, organizations, current_ts, org_list=None):
+    if org_list is None:
+        org_list = list(organizations.keys())
+    plan = workPlanner.plan_organizations(pruner.logger, conf_yaml, org_list)
+
+    results = {}
+    missing_organizations = [org for org in plan if org not in organizations]
+    for org, parameters in plan.items():
+        if org in organizations:
+            results[org] = simulate_organization(org, organizations[org], parameters, current_ts)
+
+    return results, missing_organizations
+
+
+# Return the list of (quay_url, conf_yaml) to simulate. If the configuration file doesn't define the key 'registries',
+# the rules are applied to the registry quay_url or to the only registry of the snapshot
+def get_simulated_registries(conf_yaml, snapshot, quay_url):
+    if 'registries' in conf_yaml.keys():
+        return [(registry["quay_url"], registry) for registry in conf_yaml["registries"]]
+    if quay_url is None:
+        if len(snapshot["registries"]) != 1:
+            pruner.logger.error(f"The snapshot contains the registries {list(snapshot['registries'].keys())}, "
+                                f"use the option --quay-url to select the registry to simulate")
+            os._exit(1)
+        quay_url = list(snapshot["registries"].keys())[0]
+    return [(quay_url, conf_yaml)]
+
+
+def format_simulation_report(quay_url, results, missing_organizations):
+    lines = []
+    for org, result in sorted(results.items()):
+        lines.append(f"Registry {quay_url} organization {org}: repositories {result['repositories']}, "
+                     f"tags {result['tags']}, tags deleted {result['tags_deleted']}, "
+                     f"bytes deleted {result['bytes_deleted']}")
+    lines.append(f"Registry {quay_url} total: organizations {len(results)}, "
+                 f"tags deleted {sum(result['tags_deleted'] for result in results.values())}, "
+                 f"bytes deleted {sum(result['bytes_deleted'] for result in results.values())}")
+    if missing_organizations:
+        lines.append(f"Registry {quay_url} organizations to prune but missing from the snapshot: "
+                     f"{sorted(missing_organizations)}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a pruner configuration file against an exported snapshot")
+    parser.add_argument("snapshot", help="snapshot file exported using the environment variable SNAPSHOT_EXPORT_FILE")
+    parser.add_argument("config", help="candidate configuration file config.yaml")
+    parser.add_argument("--quay-url", help="registry of the snapshot to simulate when config.yaml doesn't define "
+                                           "the key 'registries'")
+    parser.add_argument("--current-ts", type=int,
+                        help="timestamp used to evaluate keep_tags_younger_than (default: the timestamp of the "
+                             "snapshot export)")
+    args = parser.parse_args()
+
+    pruner.logger = pruner.setup_logger()
+    pruner.logger.setLevel(logging.INFO)
+    logger = pruner.logger
+
+    with open(args.config, "r") as fp:
+        conf_yaml = yaml.safe_load(fp.read())
+    checkConfiguration.check_configuration_file(logger, conf_yaml, check_tokens=False)
+
+    snapshot = registrySnapshot.load(args.snapshot)
+    current_ts = args.current_ts if args.current_ts is not None else snapshot["exported_ts"]
+
+    for quay_url, registry_conf in get_simulated_registries(conf_yaml, snapshot, args.quay_url):
+        if quay_url not in snapshot["registries"]:
+            logger.warning(f"The registry {quay_url} is not present in the snapshot {args.snapshot}")
+            continue
+        org_list = snapshot["organizations"].get(quay_url)
+        if org_list is None and registry_conf["default_rule"]["enabled"]:
+            logger.warning(f"The snapshot doesn't contain the list of all the organizations of the registry {quay_url} "
+                           f"(it has been exported with the default rule disabled): the default rule is applied only "
+                           f"to the organizations of the snapshot")
+        results, missing_organizations = simulate_registry(registry_conf, snapshot["registries"][quay_url],
+                                                           current_ts, org_list)
+        logger.info(f"Simulation report:\n{format_simulation_report(quay_url, results, missing_organizations)}")
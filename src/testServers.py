@@ -0,0 +1,142 @@
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from prunerLib import httpTransport
+from prunerLib import quayApi
+
+# Local Quay API servers used by the tests and by the benchmarks of the HTTP transports. handler(method, path) returns
+# the tuple (status, body) of the response, which is sent latency seconds after the request has been received.
+# Http2TestServer speaks cleartext HTTP/2 (the transport http2), Http1TestServer speaks HTTP/1.1 (the transport
+# requests). configure_http2_test_registry and configure_http1_test_registry configure a registry whose requests are
+# sent to the test server instead of https://<quay_url>.
+
+
+# Minimal HTTP/2 server (cleartext, prior knowledge). The requests sent concurrently by the client are in flight at the
+# same time on the server: it records the number of connections and the maximum number of streams in flight on a
+# connection
+class Http2TestServer:
+    def __init__(self, handler, latency=0.2):
+        self.handler = handler
+        self.latency = latency
+        self.connections = 0
+        self.max_streams_in_flight = 0
+        self.requests = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        import h2.config
+        import h2.connection
+        import h2.events
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+        # Tuples (response_ts, stream_id, method, path) of the requests waiting for their response
+        in_flight = []
+        while True:
+            sock.settimeout(max(in_flight[0][0] - time.monotonic(), 0.001) if in_flight else None)
+            try:
+                data = sock.recv(65535)
+                if not data:
+                    break
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        headers = dict(event.headers)
+                        in_flight.append((time.monotonic() + self.latency, event.stream_id, headers[":method"],
+                                          headers[":path"]))
+                        self.requests.append((headers[":method"], headers[":path"]))
+                        self.max_streams_in_flight = max(self.max_streams_in_flight, len(in_flight))
+            except socket.timeout:
+                pass
+            while in_flight and in_flight[0][0] <= time.monotonic():
+                _, stream_id, method, path = in_flight.pop(0)
+                status, body = self.handler(method, path)
+                connection.send_headers(stream_id, [(":status", str(status)), ("content-length", str(len(body)))],
+                                        end_stream=body == b"")
+                if body != b"":
+                    connection.send_data(stream_id, body, end_stream=True)
+            sock.sendall(connection.data_to_send())
+        sock.close()
+
+    def stop(self):
+        self.listener.close()
+
+
+# HTTP/1.1 server handling each connection in its own thread
+class Http1TestServer:
+    def __init__(self, handler, latency=0.2):
+        self.requests = []
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                server.requests.append((self.command, self.path))
+                time.sleep(latency)
+                status, body = handler(self.command, self.path)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = handle_request
+            do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        self.http_server.daemon_threads = True
+        self.port = self.http_server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+
+# Transport requests sending the requests in cleartext to a local port
+class RedirectedRequestsTransport(httpTransport.RequestsTransport):
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    def request(self, method, url, headers, timeout):
+        url = urlsplit(url)._replace(scheme="http", netloc=f"127.0.0.1:{self.port}").geturl()
+        return super().request(method, url, headers, timeout)
+
+
+# Configure quay_url with the HTTP/2 transport sending the requests in cleartext to the test server
+def configure_http2_test_registry(quay_url, server):
+    import httpx
+
+    def redirect_to_test_server(request):
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=server.port)
+
+    quayApi.configure_registry(quay_url, transport_name="http2")
+    quayApi.registry_transports[quay_url] = httpTransport.Http2Transport(client=httpx.Client(
+        http1=False, http2=True, event_hooks={"request": [redirect_to_test_server]}
+    ))
+
+
+# Configure quay_url with the transport requests sending the requests in cleartext to the test server
+def configure_http1_test_registry(quay_url, server):
+    quayApi.configure_registry(quay_url, transport_name="requests")
+    quayApi.registry_transports[quay_url] = RedirectedRequestsTransport(server.port)
@@ -0,0 +1,143 @@
+import logging
+import os
+import time
+import tracemalloc
+import pytest
+import pruner
+from prunerLib import checkConfiguration
+from prunerLib import quayApi
+from testServers import Http1TestServer, Http2TestServer, configure_http1_test_registry, configure_http2_test_registry
+
+# Micro-benchmarks of the functions executed for each repository (tag selection) and of the configuration validation.
+# Each benchmark asserts a time budget and an allocation budget proportional to the size of the input, so an
+# algorithmic regression (i.e. a quadratic loop over the tags) fails the test suite.
+# The time budgets can be scaled on slow machines using the environment variable PRUNER_BENCHMARK_TIME_FACTOR.
+# The HTTP transports are compared deleting the same tags through local servers (testServers) answering each request
+# after a fixed latency: the transport http2 must be faster than the transport requests by HTTP2_MIN_SPEEDUP.
+
+TIME_FACTOR = float(os.getenv("PRUNER_BENCHMARK_TIME_FACTOR", "1.0"))
+CURRENT_TS = 1700000000
+
+# Budgets for each tag of the repository
+SELECTION_SECONDS_PER_TAG = 5e-6
+SELECTION_BYTES_PER_TAG = 200
+PRETTIFY_SECONDS_PER_TAG = 3e-6
+PRETTIFY_BYTES_PER_TAG = 600
+
+# Budgets for each pruning parameter of the configuration file
+VALIDATION_SECONDS_PER_PARAMETER = 1e-4
+VALIDATION_BYTES_PER_PARAMETER = 500
+
+TAG_NUMBERS = [1000, 100000, 1000000]
+
+# Tags deleted through each HTTP transport and latency of each response of the test servers
+TRANSPORT_TAG_NUMBER = 50
+TRANSPORT_LATENCY_SECONDS = 0.02
+HTTP2_MIN_SPEEDUP = 2.0
+
+pruner.logger = logging.getLogger("pruner-benchmark")
+pruner.logger.setLevel(logging.INFO)
+
+
+def generate_tags(tag_number):
+    return {"tags": [
+        {
+            "name": f"v1.{i // 1000}.{i % 1000}-{'rc' if i % 3 else 'prod'}{i % 7}",
+            "start_ts": CURRENT_TS - (i * 7919) % tag_number * 60,
+            "last_modified": "Sun, 19 May 2019 10:37:38 -0000",
+            "manifest_digest": "sha256:3222549da9edd114770975510e425674282d176e19af1e24a40a2b846cb5a925",
+            "size": 49165450
+        }
+        for i in range(tag_number)
+    ]}
+
+
+def generate_configuration(rule_number, parameter_number):
+    parameters = [
+        {"tag_filter": f"^v{i}\\.[0-9]+\\.[0-9]+-(rc|dev)[0-9]+$", "keep_n_tags": str(i),
+         "keep_tags_younger_than": "30"}
+        for i in range(parameter_number)
+    ]
+    return {
+        "rules": [
+            {"organization_list": [f"org{i}", f"team{i}"], "parameters": parameters}
+            for i in range(rule_number)
+        ],
+        "default_rule": {"enabled": True, "exclude_organizations_regex": "^org[0-9]+$", "parameters": parameters}
+    }
+
+
+# Return the elapsed time and the peak of the memory allocated by function. The two values are measured in two
+# different executions because tracemalloc slows down the execution
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+@pytest.fixture(scope="module", params=TAG_NUMBERS, ids=[f"{n}-tags" for n in TAG_NUMBERS])
+def tags(request):
+    return generate_tags(request.param)
+
+
+@pytest.mark.parametrize("parameter", [
+    {"tag_filter": ".", "keep_n_tags": "10"},
+    {"tag_filter": "-rc[0-9]$", "keep_tags_younger_than": "30"},
+    {"tag_filter": "-rc[0-9]$", "keep_n_tags": "10", "keep_tags_younger_than": "30"},
+], ids=["keep_n_tags", "keep_tags_younger_than", "both"])
+def test_benchmark_select_tags_to_remove(tags, parameter):
+    tag_number = len(tags["tags"])
+    elapsed, peak = measure(pruner.select_tags_to_remove, "myorg", "myimage", tags, parameter, CURRENT_TS)
+    assert elapsed < SELECTION_SECONDS_PER_TAG * tag_number * TIME_FACTOR
+    assert peak < SELECTION_BYTES_PER_TAG * tag_number
+
+
+def test_benchmark_prettify_tag_list_of_dict(tags):
+    tag_number = len(tags["tags"])
+    elapsed, peak = measure(pruner.prettify_tag_list_of_dict, tags["tags"])
+    assert elapsed < PRETTIFY_SECONDS_PER_TAG * tag_number * TIME_FACTOR
+    assert peak < PRETTIFY_BYTES_PER_TAG * tag_number
+
+
+@pytest.mark.parametrize("rule_number,parameter_number", [(10, 10), (500, 20)])
+def test_benchmark_check_configuration_file(rule_number, parameter_number):
+    conf_yaml = generate_configuration(rule_number, parameter_number)
+    total_parameter_number = (rule_number + 1) * parameter_number
+    elapsed, peak = measure(checkConfiguration.check_configuration_file, pruner.logger, conf_yaml)
+    assert elapsed < VALIDATION_SECONDS_PER_PARAMETER * total_parameter_number * TIME_FACTOR
+    assert peak < VALIDATION_BYTES_PER_PARAMETER * total_parameter_number
+
+
+# Return the seconds spent deleting TRANSPORT_TAG_NUMBER tags through the test server created by server_class
+def measure_delete_tags(server_class, configure_test_registry):
+    server = server_class(lambda method, path: (204, b""), latency=TRANSPORT_LATENCY_SECONDS)
+    server.start()
+    quay_url = f"quay-{server_class.__name__.lower()}.example.org"
+    tags = [{"name": f"1.0.{i}"} for i in range(TRANSPORT_TAG_NUMBER)]
+    try:
+        configure_test_registry(quay_url, server)
+        start = time.perf_counter()
+        errors = quayApi.delete_tags(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage", tags)
+        elapsed = time.perf_counter() - start
+    finally:
+        quayApi.configure_registry(quay_url)
+        server.stop()
+    assert errors == []
+    return elapsed
+
+
+def test_benchmark_delete_tags_http_transports():
+    requests_elapsed = measure_delete_tags(Http1TestServer, configure_http1_test_registry)
+    http2_elapsed = measure_delete_tags(Http2TestServer, configure_http2_test_registry)
+    pruner.logger.info(f"Deletion of {TRANSPORT_TAG_NUMBER} tags: transport requests {requests_elapsed:.3f} seconds, "
+                       f"transport http2 {http2_elapsed:.3f} seconds")
+    assert requests_elapsed >= TRANSPORT_TAG_NUMBER * TRANSPORT_LATENCY_SECONDS
+    assert http2_elapsed * HTTP2_MIN_SPEEDUP < requests_elapsed
@@ -1,4 +1,10 @@
+import logging
+import re
 import pruner
+from prunerLib import quayApi
+from testServers import Http2TestServer, configure_http2_test_registry
+
+pruner.logger = logging.getLogger("pruner-test")
 
 
 def test_get_repos_json(requests_mock):
@@ -10,7 +16,7 @@ def test_get_repos_json(requests_mock):
     quay_url = 'quay.example.org'
     quay_org = "myorg"
     token = "d34db33f"
-    repos = pruner.get_repo_list_json(quay_url, token, quay_org)
+    repos = quayApi.get_repo_list_json(pruner.logger, quay_url, token, 60.0, quay_org)
     assert repos == {"repositories": []}
 
 
@@ -43,7 +49,7 @@ def test_get_tags_json(requests_mock):
     quay_org = "myorg"
     token = "d34db33f"
     image_name = "myimage"
-    tags = pruner.get_tags_json(quay_url, token, quay_org, image_name)
+    tags = quayApi.get_tags_json(pruner.logger, quay_url, token, 60.0, quay_org, image_name)
     assert tags['tags'][0]["name"] == "latest"
 
 
@@ -111,7 +117,8 @@ def test_tags_to_remove():
             }
         ]
     }
-    filtered_tags = pruner.select_tags_to_remove(payload, r'-rc\d+$', 0)
+    parameter = {"tag_filter": r'-rc\d+$', "keep_n_tags": "0"}
+    filtered_tags = pruner.select_tags_to_remove("myorg", "myimage", payload, parameter, 1558262258)
     assert len(filtered_tags) == 2
     assert all('-rc' in tag['name'] for tag in filtered_tags)
 
@@ -144,4 +151,661 @@ def test_delete_tags(requests_mock):
     quay_org = "myorg"
     token = "d34db33f"
     image_name = "myimage"
-    pruner.delete_tags(quay_url, token, quay_org, image_name, tags_to_remove)
+    errors = quayApi.delete_tags(pruner.logger, quay_url, token, 60.0, quay_org, image_name, tags_to_remove)
+    assert errors == []
+
+
+def test_prune_registries_uses_each_registry_token(requests_mock, monkeypatch):
+    from prunerLib import checkConfiguration
+    monkeypatch.setenv("QUAY1_APP_TOKEN", "t0k3n1")
+    monkeypatch.setenv("QUAY2_APP_TOKEN", "t0k3n2")
+    rule = {
+        "rules": [{"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "1"}]}],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+    conf_yaml = {
+        "registries": [
+            dict(rule, quay_url="quay1.example.org", quay_app_token_env="QUAY1_APP_TOKEN",
+                 max_requests_per_second="100"),
+            dict(rule, quay_url="quay2.example.org", quay_app_token_env="QUAY2_APP_TOKEN")
+        ]
+    }
+    checkConfiguration.check_configuration_file(pruner.logger, conf_yaml)
+    for host in ["quay1.example.org", "quay2.example.org"]:
+        requests_mock.get(f"https://{host}/api/v1/repository?namespace=myorg", json={"repositories": []})
+
+    registries = pruner.get_registries_list(conf_yaml)
+    pruner.configure_registries(registries)
+    reports = pruner.prune_registries(registries, 60.0, False, True)
+
+    assert [report["quay_url"] for report in reports] == ["quay1.example.org", "quay2.example.org"]
+    assert all(report["organizations"] == 1 and report["errors"] == [] for report in reports)
+    tokens = sorted(request.headers["Authorization"] for request in requests_mock.request_history)
+    assert tokens == ["Bearer t0k3n1", "Bearer t0k3n2"]
+
+
+def test_prune_registries_isolates_registry_errors(requests_mock):
+    conf = {
+        "rules": [{"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "1"}]}],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+    registries = [
+        {"quay_url": host, "app_token": "d34db33f", "max_requests_per_second": 0.0, "conf": conf}
+        for host in ["quay-down.example.org", "quay-up.example.org"]
+    ]
+    requests_mock.get("https://quay-down.example.org/api/v1/repository?namespace=myorg", status_code=503,
+                      reason="Service Unavailable", text="down")
+    requests_mock.get("https://quay-up.example.org/api/v1/repository?namespace=myorg", json={"repositories": []})
+    pruner.configure_registries(registries)
+    reports = pruner.prune_registries(registries, 60.0, False, True)
+
+    assert len(reports[0]["errors"]) == 1 and "503" in reports[0]["errors"][0]
+    assert reports[1]["organizations"] == 1 and reports[1]["errors"] == []
+
+
+def test_prune_registry_keeps_partial_report_on_unexpected_errors(requests_mock):
+    import requests
+    quay_url = "quay-partial.example.org"
+    requests_mock.get(f"https://{quay_url}/api/v1/repository?namespace=orga",
+                      json={"repositories": [{"name": "myimage"}]})
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/orga/myimage", json={"state": "NORMAL"})
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/orga/myimage/tag/", json={
+        "has_additional": False,
+        "tags": [{"name": f"1.0.{i}", "start_ts": i, "last_modified": ""} for i in range(2)]
+    })
+    requests_mock.delete(f"https://{quay_url}/api/v1/repository/orga/myimage/tag/1.0.0", status_code=500,
+                         reason="Internal Server Error", text="error")
+    requests_mock.get(f"https://{quay_url}/api/v1/repository?namespace=orgb", exc=requests.exceptions.ReadTimeout)
+    conf_yaml = {
+        "rules": [{"organization_list": ["orga", "orgb"], "parameters": [{"tag_filter": ".", "keep_n_tags": "1"}]}],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+    registries = [{"quay_url": quay_url, "app_token": "d34db33f", "max_requests_per_second": 0.0, "conf": conf_yaml}]
+    pruner.configure_registries(registries)
+    report = pruner.prune_registries(registries, 60.0, False, False)[0]
+
+    assert (report["organizations"], report["repositories"], report["tags_selected"]) == (2, 1, 1)
+    assert len(report["errors"]) == 2
+    assert "1.0.0" in report["errors"][0] and "ReadTimeout" in report["errors"][1]
+    assert report["api_calls"] == 5 and not report["completed"]
+
+
+def test_get_tags_json_http2_transport():
+    import json
+
+    def handler(method, path):
+        page = int(path.rsplit("page=", 1)[1])
+        return 200, json.dumps({
+            "has_additional": page == 1,
+            "page": page,
+            "tags": [{"name": f"tag{page}", "start_ts": page, "last_modified": ""}]
+        }).encode()
+
+    server = Http2TestServer(handler)
+    server.start()
+    quay_url = 'quay-http2.example.org'
+    try:
+        configure_http2_test_registry(quay_url, server)
+        tags = quayApi.get_tags_json(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage")
+    finally:
+        quayApi.configure_registry(quay_url)
+        server.stop()
+    assert [tag["name"] for tag in tags["tags"]] == ["tag1", "tag2"]
+
+
+def test_delete_tags_http2_transport_multiplexes_requests():
+    server = Http2TestServer(lambda method, path: (204, b"") if not path.endswith("missing") else (500, b"error"))
+    server.start()
+    quay_url = 'quay-http2-delete.example.org'
+    tags = [{"name": f"1.0.{i}"} for i in range(5)] + [{"name": "missing"}]
+    try:
+        configure_http2_test_registry(quay_url, server)
+        errors = quayApi.delete_tags(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage", tags)
+    finally:
+        quayApi.configure_registry(quay_url)
+        server.stop()
+    assert len(errors) == 1 and "missing" in errors[0]
+    assert sorted(path for method, path in server.requests) == sorted(
+        f"/api/v1/repository/myorg/myimage/tag/{tag['name']}" for tag in tags)
+    assert server.connections == 1
+    assert server.max_streams_in_flight == len(tags)
+
+
+def test_http2_transport_maps_transport_errors():
+    import httpx
+    import pytest
+    from prunerLib import httpTransport
+
+    def handler(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    transport = httpTransport.Http2Transport(client=httpx.Client(transport=httpx.MockTransport(handler)))
+    with pytest.raises(httpTransport.TransportConnectionError):
+        transport.request("GET", "https://quay.example.org/api/v1/repository", {}, 1.0)
+
+
+def test_memory_profiler_nested_scopes():
+    from prunerLib import memoryProfiler
+    memoryProfiler.start(top_allocations_number=3)
+    try:
+        with memoryProfiler.measure("organization", "quay.example.org/myorg"):
+            with memoryProfiler.measure("repository", "quay.example.org/myorg/myimage"):
+                payload = [bytearray(1024) for _ in range(1024)]
+                del payload
+        report = memoryProfiler.format_report()
+    finally:
+        memoryProfiler.stop()
+
+    repository = memoryProfiler.measurements["repository"]["quay.example.org/myorg/myimage"]
+    organization = memoryProfiler.measurements["organization"]["quay.example.org/myorg"]
+    assert repository["traced_peak"] >= 1024 * 1024
+    assert organization["traced_peak"] >= repository["traced_peak"]
+    assert "current_rss" in repository and "current_rss" in organization
+    assert "Organization quay.example.org/myorg" in report
+    assert "pruned one at a time" in report.splitlines()[0]
+
+
+def test_memory_profiler_concurrent_scopes():
+    import threading
+    import time
+    from prunerLib import memoryProfiler
+    allocated = threading.Event()
+
+    # The organization allocates and releases 8 MiB, then another thread opens a scope before the organization ends
+    def prune_organization():
+        with memoryProfiler.measure("organization", "quay1.example.org/myorg"):
+            payload = bytearray(8 * 1024 * 1024)
+            del payload
+            allocated.set()
+            time.sleep(0.2)
+
+    def prune_other_registry():
+        allocated.wait()
+        with memoryProfiler.measure("organization", "quay2.example.org/myorg"):
+            pass
+
+    memoryProfiler.start(top_allocations_number=3)
+    try:
+        threads = [threading.Thread(target=prune_organization), threading.Thread(target=prune_other_registry)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        memoryProfiler.stop()
+    assert memoryProfiler.measurements["organization"]["quay1.example.org/myorg"]["traced_peak"] >= 8 * 1024 * 1024
+
+
+def test_simulate_registry_from_snapshot(tmp_path):
+    import simulator
+    from prunerLib import registrySnapshot
+    registrySnapshot.start_export()
+    registrySnapshot.record_repository("quay.example.org", "myorg", "myimage", {"tags": [
+        {"name": f"1.0.{i}", "start_ts": 1000 + i, "size": 10} for i in range(5)
+    ]})
+    registrySnapshot.record_repository("quay.example.org", "otherorg", "otherimage", {"tags": [
+        {"name": "latest", "start_ts": 1000, "size": 10}
+    ]})
+    registrySnapshot.record_organization("quay.example.org", "emptyorg")
+    registrySnapshot.record_organization_list("quay.example.org", ["myorg", "otherorg", "emptyorg", "newteam"])
+    snapshot_file = tmp_path / "snapshot.json.gz"
+    try:
+        registrySnapshot.write(snapshot_file)
+    finally:
+        registrySnapshot.enabled = False
+        registrySnapshot.snapshot["registries"].clear()
+        registrySnapshot.snapshot["organizations"].clear()
+
+    snapshot = registrySnapshot.load(snapshot_file)
+    conf_yaml = {
+        "rules": [{"organization_list": ["myorg", "missingorg"],
+                   "parameters": [{"tag_filter": ".", "keep_n_tags": "2"}]}],
+        "default_rule": {"enabled": True, "exclude_organizations_regex": "",
+                         "parameters": [{"tag_filter": ".", "keep_tags_younger_than": "1"}]}
+    }
+    results, missing_organizations = simulator.simulate_registry(
+        conf_yaml, snapshot["registries"]["quay.example.org"], 1000 + 2 * 24 * 3600,
+        snapshot["organizations"]["quay.example.org"]
+    )
+    assert results["myorg"] == {"repositories": 1, "tags": 5, "tags_deleted": 3, "bytes_deleted": 30}
+    assert results["otherorg"]["tags_deleted"] == 1
+    assert results["emptyorg"] == {"repositories": 0, "tags": 0, "tags_deleted": 0, "bytes_deleted": 0}
+    assert missing_organizations == ["missingorg", "newteam"]
+
+    # Without the list of the organizations the default rule is applied to the organizations of the snapshot
+    results, missing_organizations = simulator.simulate_registry(
+        conf_yaml, snapshot["registries"]["quay.example.org"], 1000 + 2 * 24 * 3600
+    )
+    assert sorted(results) == ["emptyorg", "myorg", "otherorg"] and missing_organizations == ["missingorg"]
+
+
+def test_plan_organizations_merges_rules():
+    from prunerLib import workPlanner
+    keep_5 = {"tag_filter": ".", "keep_n_tags": "5"}
+    keep_rc = {"tag_filter": "-rc", "keep_n_tags": "1"}
+    conf_yaml = {
+        "rules": [
+            {"organization_list": ["org1", "org2", "org1"], "parameters": [keep_5]},
+            {"organization_list": ["org2", 3], "parameters": [keep_rc, keep_5]}
+        ],
+        "default_rule": {"enabled": True, "exclude_organizations_regex": "^excluded",
+                         "parameters": [{"tag_filter": ".", "keep_tags_younger_than": "30"}]}
+    }
+    plan = workPlanner.plan_organizations(pruner.logger, conf_yaml, ["org1", "org2", "3", "excluded1", "org4"])
+    assert plan == {
+        "org1": [keep_5],
+        "org2": [keep_5, keep_rc],
+        "3": [keep_rc, keep_5],
+        "org4": [{"tag_filter": ".", "keep_tags_younger_than": "30"}]
+    }
+    assert workPlanner.count_expected_api_calls(plan, True) == 5
+
+
+def test_prune_registry_fetches_each_repository_once(requests_mock):
+    quay_url = "quay-plan.example.org"
+    repo_list = requests_mock.get(f"https://{quay_url}/api/v1/repository?namespace=myorg",
+                                  json={"repositories": [{"name": "myimage"}]})
+    repo = requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage", json={"state": "NORMAL"})
+    tags = requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/", json={
+        "has_additional": False,
+        "tags": [{"name": f"1.0.{i}", "start_ts": i, "last_modified": ""} for i in range(5)]
+    })
+    conf_yaml = {
+        "rules": [
+            {"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "3"}]},
+            {"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "1"}]}
+        ],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+    quayApi.configure_registry(quay_url)
+    report = pruner.prune_registry(quay_url, "d34db33f", 60.0, conf_yaml, False, True)
+    assert (repo_list.call_count, repo.call_count, tags.call_count) == (1, 1, 1)
+    assert report["tags_selected"] == 4
+    assert report["api_calls"] == report["expected_api_calls"] == 3
+
+
+def test_check_environment_variables_rejects_snapshot_in_webhook_mode(monkeypatch):
+    import pytest
+    from prunerLib import checkConfiguration
+    for name, value in [("DEBUG", "False"), ("DRY_RUN", "True"), ("WEBHOOK_LISTEN_PORT", "8080"),
+                        ("WEBHOOK_TOKEN", "s3cr3t")]:
+        monkeypatch.setenv(name, value)
+    checkConfiguration.check_environment_variables(pruner.logger)
+    monkeypatch.setenv("SNAPSHOT_EXPORT_FILE", "/tmp/snapshot.json.gz")
+    with pytest.raises(SystemExit):
+        checkConfiguration.check_environment_variables(pruner.logger)
+
+
+def test_webhook_push_queue_debounces_pushes():
+    from prunerLib import webhookReceiver
+    payload = {
+        "repository": "myorg/myimage", "namespace": "myorg", "name": "myimage",
+        "docker_url": "quay.example.org/myorg/myimage", "updated_tags": ["latest"]
+    }
+    pushed_repository = webhookReceiver.parse_push_payload(payload)
+    assert pushed_repository == ("quay.example.org", "myorg", "myimage")
+    assert webhookReceiver.parse_push_payload({"updated_tags": ["latest"]}) is None
+
+    push_queue = webhookReceiver.PushQueue()
+    push_queue.push(*pushed_repository)
+    push_queue.push(*pushed_repository)
+    assert push_queue.pop_due(60) == []
+    assert push_queue.pop_due(0) == [pushed_repository]
+    assert len(push_queue) == 0
+
+
+def test_webhook_push_queue_releases_repositories_pushed_continuously(monkeypatch):
+    import time
+    from prunerLib import webhookReceiver
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    push_queue = webhookReceiver.PushQueue()
+    released = []
+    # A push every 30 seconds with a debounce of 60 seconds: the repository is released after 4 debounce intervals
+    while not released:
+        push_queue.push("quay.example.org", "myorg", "busy")
+        clock[0] += 30
+        released = push_queue.pop_due(60)
+    assert released == [("quay.example.org", "myorg", "busy")]
+    assert clock[0] - 1000.0 == 4 * 60
+
+    # The next push starts a new wait
+    push_queue.push("quay.example.org", "myorg", "busy")
+    clock[0] += 30
+    assert push_queue.pop_due(60) == []
+    assert push_queue.pop_due(60, max_wait_seconds=30) == [("quay.example.org", "myorg", "busy")]
+
+
+def test_webhook_worker_prunes_scheduled_repositories():
+    import threading
+    from prunerLib import webhookReceiver
+    scheduled = [[("quay.example.org", "myorg", "expiring")], []]
+    pruned = []
+    stop_event = threading.Event()
+
+    def prune_repository(quay_host, organization, repository):
+        pruned.append((quay_host, organization, repository))
+        stop_event.set()
+
+    webhookReceiver.run_worker(pruner.logger, webhookReceiver.PushQueue(), prune_repository, lambda: None, 0, 3600,
+                               stop_event, 0.01, lambda: scheduled.pop(0) if scheduled else [])
+    assert pruned == [("quay.example.org", "myorg", "expiring")]
+
+
+def test_prune_pushed_repository_uses_organization_rule(requests_mock):
+    quay_url = "quay-webhook.example.org"
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage", json={"state": "NORMAL"})
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/", json={
+        "has_additional": False,
+        "tags": [{"name": f"1.0.{i}", "start_ts": i, "last_modified": ""} for i in range(5)]
+    })
+    delete = requests_mock.delete(re.compile(f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/.+"))
+    registries = [{
+        "quay_url": quay_url,
+        "app_token": "d34db33f",
+        "max_requests_per_second": 0.0,
+        "conf": {
+            "rules": [{"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "3"}]}],
+            "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+        }
+    }]
+    pruner.configure_registries(registries)
+    pruner.prune_pushed_repository(registries, 60.0, False, None, "myorg", "myimage")
+    pruner.prune_pushed_repository(registries, 60.0, False, quay_url, "otherorg", "otherimage")
+    assert sorted(request.path.rsplit("/", 1)[1] for request in delete.request_history) == ["1.0.0", "1.0.1"]
+
+
+def test_webhook_worker_survives_missing_repository(requests_mock, caplog):
+    import json
+    import threading
+    import urllib.error
+    import urllib.request
+    from http.server import ThreadingHTTPServer
+    from prunerLib import webhookReceiver
+    quay_url = "quay-webhook-missing.example.org"
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/missing", status_code=404,
+                      reason="Not Found", text="not found")
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/missing/tag/", status_code=404,
+                      reason="Not Found", text="not found")
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage", json={"state": "NORMAL"})
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/", json={
+        "has_additional": False,
+        "tags": [{"name": f"1.0.{i}", "start_ts": i, "last_modified": ""} for i in range(2)]
+    })
+    delete = requests_mock.delete(re.compile(f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/.*"),
+                                  status_code=204)
+    registries = [{
+        "quay_url": quay_url, "app_token": "d34db33f", "max_requests_per_second": 0.0,
+        "conf": {
+            "rules": [{"organization_list": ["myorg"], "parameters": [{"tag_filter": ".", "keep_n_tags": "1"}]}],
+            "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+        }
+    }]
+    pruner.configure_registries(registries)
+
+    push_queue = webhookReceiver.PushQueue()
+    server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                 webhookReceiver.create_request_handler(pruner.logger, push_queue, "s3cr3t"))
+    stop_event = threading.Event()
+    worker = threading.Thread(target=webhookReceiver.run_worker, args=(
+        pruner.logger, push_queue,
+        lambda host, org, repo: pruner.prune_pushed_repository(registries, 60.0, False, host, org, repo),
+        lambda: None, 0, 3600, stop_event, 0.05
+    ), daemon=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    worker.start()
+    try:
+        for repository in ["missing", "myimage"]:
+            payload = json.dumps({"namespace": "myorg", "name": repository,
+                                  "docker_url": f"{quay_url}/myorg/{repository}"}).encode()
+            request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/?token=s3cr3t", data=payload,
+                                             method="POST")
+            assert urllib.request.urlopen(request).status == 202
+            for _ in range(100):
+                if len(push_queue) == 0 and (repository == "missing" or delete.called):
+                    break
+                threading.Event().wait(0.05)
+        for path in ["/", "/?token=wrong", "/?token=s3cr3t&token=s3cr3t"]:
+            request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}{path}", data=b"{}",
+                                             method="POST")
+            try:
+                urllib.request.urlopen(request)
+                assert False, f"The notification {path} has been accepted"
+            except urllib.error.HTTPError as err:
+                assert err.code == 403
+        assert worker.is_alive()
+        assert [request.path.rsplit("/", 1)[1] for request in delete.request_history] == ["1.0.0"]
+        assert "The repository myorg/missing of the registry" in caplog.text
+        assert "Error pruning the repository" not in caplog.text
+    finally:
+        stop_event.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_prune_registry_with_selection_pool(requests_mock):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from prunerLib import tagSelection
+    quay_url = "quay-pool.example.org"
+    requests_mock.get(f"https://{quay_url}/api/v1/repository?namespace=myorg",
+                      json={"repositories": [{"name": f"myimage{i}"} for i in range(3)]})
+    for i in range(3):
+        requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage{i}", json={"state": "NORMAL"})
+        requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/myimage{i}/tag/", json={
+            "has_additional": False,
+            "tags": [{"name": f"1.0.{j}-rc{j % 2}", "start_ts": j, "last_modified": ""} for j in range(10)]
+        })
+    parameters = [{"tag_filter": "-rc1$", "keep_n_tags": "1"}, {"tag_filter": ".", "keep_n_tags": "4"}]
+    conf_yaml = {
+        "rules": [{"organization_list": ["myorg"], "parameters": parameters}],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+    tags = {"tags": [{"name": f"1.0.{j}-rc{j % 2}", "start_ts": j, "last_modified": ""} for j in range(10)]}
+    expected_names = [tag["name"] for tag in
+                      pruner.select_repository_tags_to_remove("myorg", "myimage0", tags, parameters, 100)]
+    compact_tags = [(tag["name"], tag["start_ts"]) for tag in tags["tags"]]
+    assert tagSelection.select_tag_names_to_remove(compact_tags, parameters, 100) == expected_names
+
+    quayApi.configure_registry(quay_url)
+    pruner.selection_pool_processes = 1
+    pruner.selection_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        report = pruner.prune_registry(quay_url, "d34db33f", 60.0, conf_yaml, False, True)
+    finally:
+        pruner.selection_pool.shutdown()
+        pruner.selection_pool = None
+        pruner.selection_pool_processes = 0
+    assert report["repositories"] == 3
+    assert report["tags_selected"] == 3 * len(expected_names)
+
+
+def test_prune_registry_with_expiry_index(requests_mock, tmp_path):
+    import time
+    from prunerLib import expiryIndex, tagSelection
+    quay_url = "quay-expiry.example.org"
+    current_ts = int(time.time())
+    day = 24 * 3600
+    requests_mock.get(f"https://{quay_url}/api/v1/repository?namespace=myorg", json={"repositories": [
+        {"name": "myimage", "last_modified": 100}, {"name": "pushed", "last_modified": 200}
+    ]})
+    for image in ["myimage", "pushed"]:
+        requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/{image}", json={"state": "NORMAL"})
+        requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/{image}/tag/", json={
+            "has_additional": False,
+            "tags": [{"name": f"1.0.{j}", "start_ts": current_ts - j * day, "last_modified": ""} for j in range(5)]
+        })
+    requests_mock.delete(re.compile(f"https://{quay_url}/api/v1/repository/myorg/.*/tag/.*"), status_code=204)
+    parameters = [{"tag_filter": ".", "keep_n_tags": "1", "keep_tags_younger_than": "2"}]
+    conf_yaml = {
+        "rules": [{"organization_list": ["myorg"], "parameters": parameters}],
+        "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+    }
+
+    # The tags 1.0.3 and 1.0.4 are deleted, 1.0.2 becomes older than 2 days after one day
+    remaining_tags = [{"name": f"1.0.{j}", "start_ts": current_ts - j * day} for j in range(3)]
+    assert tagSelection.get_next_selection_change_ts(remaining_tags, parameters) == current_ts + 1
+    assert tagSelection.get_next_selection_change_ts(remaining_tags[0:2], parameters) == current_ts + day + 1
+    assert tagSelection.get_next_selection_change_ts(remaining_tags, [{"tag_filter": ".", "keep_n_tags": "1"}]) is None
+
+    index_file = str(tmp_path / "expiry-index.json")
+    quayApi.configure_registry(quay_url)
+    try:
+        expiryIndex.load(index_file, current_ts)
+        expiryIndex.record_evaluation(quay_url, "myorg", "myimage", parameters, 100, current_ts + day, current_ts)
+        expiryIndex.record_evaluation(quay_url, "myorg", "pushed", parameters, 150, current_ts + day, current_ts)
+        expiryIndex.record_evaluation(quay_url, "myorg", "deleted", parameters, 150, current_ts + 2 * day, current_ts)
+        expiryIndex.write(index_file)
+
+        # myimage is not due and hasn't been pushed, pushed has been pushed after its last evaluation
+        expiryIndex.load(index_file, current_ts + 60)
+        report = pruner.prune_registry(quay_url, "d34db33f", 60.0, conf_yaml, False, False)
+        assert report["repositories"] == 1
+        assert report["repositories_skipped_by_expiry_index"] == 1
+        assert report["expected_api_calls"] == 3
+        assert expiryIndex.entries[expiryIndex.get_key(quay_url, "myorg", "pushed")]["last_modified"] == 200
+
+        # The repository deleted from the registry is removed from the index after a completed scan
+        pruner.remove_unlisted_repositories_from_expiry_index([report])
+        assert sorted(expiryIndex.entries) == [expiryIndex.get_key(quay_url, "myorg", "myimage"),
+                                               expiryIndex.get_key(quay_url, "myorg", "pushed")]
+
+        # The snapshot export evaluates all the repositories
+        from prunerLib import registrySnapshot
+        registrySnapshot.start_export()
+        try:
+            report = pruner.prune_registry(quay_url, "d34db33f", 60.0, conf_yaml, False, True)
+        finally:
+            registrySnapshot.enabled = False
+        assert report["repositories"] == 2 and report["repositories_skipped_by_expiry_index"] == 0
+        assert sorted(registrySnapshot.snapshot["registries"][quay_url]["myorg"]) == ["myimage", "pushed"]
+        registrySnapshot.snapshot["registries"].clear()
+
+        # The schedule pops the repositories in order of next evaluation timestamp: pushed (its tag 1.0.2 becomes older
+        # than 2 days after one second) and then myimage, each repository only once
+        assert expiryIndex.pop_due(current_ts + 60) == {expiryIndex.get_key(quay_url, "myorg", "pushed")}
+        assert expiryIndex.pop_due(current_ts + day) == {expiryIndex.get_key(quay_url, "myorg", "myimage")}
+        assert expiryIndex.pop_due(current_ts + day) == set()
+        assert expiryIndex.split_key(expiryIndex.get_key(quay_url, "myorg", "my/image")) == (quay_url, "myorg",
+                                                                                             "my/image")
+
+        # myimage is due one day later
+        expiryIndex.write(index_file)
+        expiryIndex.load(index_file, current_ts + day)
+        assert expiryIndex.needs_evaluation(quay_url, "myorg", "myimage", parameters, 100, current_ts + day)
+    finally:
+        expiryIndex.enabled = False
+        expiryIndex.entries.clear()
+        expiryIndex.due_keys.clear()
+        expiryIndex.seen_keys.clear()
+        expiryIndex.schedule.clear()
+
+
+def test_webhook_worker_prunes_repositories_due_at_restart(requests_mock, tmp_path):
+    import json
+    import threading
+    import time
+    from prunerLib import expiryIndex, webhookReceiver
+    quay_url = "quay-expiry-restart.example.org"
+    current_ts = int(time.time())
+    parameters = [{"tag_filter": ".", "keep_n_tags": "3"}]
+    registries = [{
+        "quay_url": quay_url,
+        "app_token": "d34db33f",
+        "max_requests_per_second": 0.0,
+        "conf": {
+            "rules": [{"organization_list": ["myorg"], "parameters": parameters}],
+            "default_rule": {"enabled": False, "exclude_organizations_regex": "", "parameters": []}
+        }
+    }]
+    requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/overdue", json={"state": "NORMAL"})
+    tags = requests_mock.get(f"https://{quay_url}/api/v1/repository/myorg/overdue/tag/", [
+        {"status_code": 503, "reason": "Service Unavailable", "text": "down"},
+        {"json": {"has_additional": False, "tags": [{"name": "1.0.0", "start_ts": 1, "last_modified": ""}]}}
+    ])
+    overdue_key = expiryIndex.get_key(quay_url, "myorg", "overdue")
+    index_file = tmp_path / "expiry-index.json"
+    index_file.write_text(json.dumps({"version": expiryIndex.INDEX_VERSION, "repositories": {
+        key: {"parameters_hash": expiryIndex.get_parameters_hash(parameters), "last_modified": 100,
+              "next_evaluation_ts": next_evaluation_ts, "evaluated_ts": current_ts - 3600}
+        for key, next_evaluation_ts in [(overdue_key, current_ts - 60),
+                                        (expiryIndex.get_key(quay_url, "myorg", "later"), current_ts + 3600)]
+    }}))
+    pruner.configure_registries(registries)
+    stop_event = threading.Event()
+
+    def prune_repository(quay_host, organization, repository):
+        try:
+            pruner.prune_pushed_repository(registries, 60.0, False, quay_host, organization, repository)
+        finally:
+            stop_event.set()
+
+    try:
+        # The receiver restarts with an entry already due: the worker prunes it without waiting for a full sweep
+        expiryIndex.load(str(index_file), current_ts)
+        webhookReceiver.run_worker(pruner.logger, webhookReceiver.PushQueue(), prune_repository, lambda: None, 0, 3600,
+                                   stop_event, 0.01, pruner.pop_scheduled_repositories)
+        assert tags.call_count == 1
+
+        # The pruning failed with a 503: the repository is scheduled again and evaluated by the next scans
+        assert expiryIndex.pop_scheduled(current_ts + 60) == set()
+        assert expiryIndex.needs_evaluation(quay_url, "myorg", "overdue", parameters, 100, current_ts + 60)
+        retry_ts = expiryIndex.entries[overdue_key]["next_evaluation_ts"]
+        assert current_ts + expiryIndex.RETRY_SECONDS <= retry_ts <= time.time() + expiryIndex.RETRY_SECONDS
+        assert overdue_key in expiryIndex.pop_scheduled(retry_ts)
+
+        # The evaluation succeeds: keep_n_tags alone doesn't schedule the repository again
+        pruner.prune_pushed_repository(registries, 60.0, False, quay_url, "myorg", "overdue")
+        assert expiryIndex.entries[overdue_key]["next_evaluation_ts"] is None
+        assert expiryIndex.entries[overdue_key]["evaluated_ts"] >= current_ts
+    finally:
+        expiryIndex.enabled = False
+        expiryIndex.entries.clear()
+        expiryIndex.due_keys.clear()
+        expiryIndex.seen_keys.clear()
+        expiryIndex.schedule.clear()
+
+
+def test_get_tags_json_with_response_cache(requests_mock, tmp_path):
+    import os
+    from prunerLib import responseCache
+    quay_url = "quay-cache.example.org"
+    tags_url = f"https://{quay_url}/api/v1/repository/myorg/myimage/tag/?onlyActiveTags=True&page=1"
+    tags = {"has_additional": False, "tags": [{"name": "1.0.0", "start_ts": 1, "last_modified": ""}]}
+    quayApi.configure_registry(quay_url)
+    try:
+        responseCache.configure(str(tmp_path), 1)
+        requests_mock.get(tags_url, json=tags, headers={"ETag": '"v1"'})
+        assert quayApi.get_tags_json(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage") == tags
+
+        requests_mock.get(tags_url, status_code=304, headers={"ETag": '"v1"'})
+        assert quayApi.get_tags_json(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage") == tags
+        assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+        assert responseCache.get_counters(quay_url) == {"hits": 1, "misses": 1}
+
+        # A response without validators removes the cached response
+        requests_mock.get(tags_url, json=tags)
+        assert quayApi.get_tags_json(pruner.logger, quay_url, "d34db33f", 60.0, "myorg", "myimage") == tags
+        assert len(responseCache.entry_sizes) == 0
+
+        # The pages of the repository listing following the first page are not cached (opaque next_page token)
+        repos_url = f"https://{quay_url}/api/v1/repository?namespace=myorg&last_modified=true"
+        requests_mock.get(repos_url, json={"repositories": [{"name": "myimage"}], "next_page": "t0k3n"},
+                          headers={"ETag": '"p1"'})
+        requests_mock.get(f"{repos_url}&next_page=t0k3n", json={"repositories": [{"name": "other"}]},
+                          headers={"ETag": '"p2"'})
+        repos = quayApi.get_repo_list_json(pruner.logger, quay_url, "d34db33f", 60.0, "myorg")
+        assert [repo["name"] for repo in repos["repositories"]] == ["myimage", "other"]
+        assert len(responseCache.entry_sizes) == 1
+        assert responseCache.get_counters(quay_url) == {"hits": 1, "misses": 3}
+
+        # The least recently used responses are removed when the cache exceeds its maximum size
+        responseCache.configure(str(tmp_path), 0.001)
+        for i in range(3):
+            responseCache.store(f"key{i}", f"url{i}", {"ETag": '"v1"'}, "x" * 600)
+        assert list(responseCache.entry_sizes) == ["key2"]
+        assert sorted(os.listdir(tmp_path)) == ["key2.json"]
+    finally:
+        responseCache.enabled = False
+        responseCache.entry_sizes.clear()
+        responseCache.counters.clear()